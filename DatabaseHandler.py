@@ -1,16 +1,24 @@
+import os
+import time
 import numpy as np
 import datetime
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
-from annoySearch import AnnoySearch  # Use your pre-built Annoy search module
+from engine_registry import get_client, get_search_engine  # Shared client and pre-built Annoy engines
 from openai_service import ChatGPT  # Service for embeddings, rephrasing, etc.
-import tiktoken  # pip install tiktoken
+import query_cache  # search_counter is replaced in forked workers
+from query_cache import query_embedding_cache, result_cache, ensure_query_indexes
+from embedding_codec import encode_embedding, decode_embedding
+import tokenizer  # Cached encodings and cheap truncation
 from config import (
     MONGO_URI,
     TOP_QUERY_RESULT,
+    THRESHOLD_QUERY_SEARCH,
     LIMIT,
     COLLECTION,
     EMBEDDING_MODEL,
+    EMBEDDING_DIMENSIONS,
 )
 
 # Configure logging.
@@ -18,7 +26,9 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(me
 logger = logging.getLogger(__name__)
 
 # Global constant for max tokens.
-MAX_TOTAL_TOKENS = 8000
+MAX_TOTAL_TOKENS = tokenizer.MAX_TOTAL_TOKENS
+# Threads used for Annoy lookups in process_queries (Annoy releases the GIL while searching).
+BATCH_SEARCH_THREADS = os.cpu_count() or 4
 
 class DatabaseHandler:
     def __init__(self, config, mongo_uri=MONGO_URI):
@@ -37,6 +47,7 @@ class DatabaseHandler:
         :param mongo_uri: The MongoDB connection URI.
         """
         # Unpack the config dictionary.
+        self.config = config
         self.db_name = config["db_name"]
         self.query_collection_name = config["query_collection_name"]
         self.embedding_collection_name = config["embedding_collection_name"]
@@ -46,33 +57,37 @@ class DatabaseHandler:
         self.document_type = config["document_type"]
         self.unique_field = config.get("unique_index", "title")
 
-        # Connect to MongoDB.
-        self.client = MongoClient(mongo_uri)
+        # Use the process-wide pooled client unless a different server was requested.
+        self._owns_client = mongo_uri != MONGO_URI
+        self.client = MongoClient(mongo_uri) if self._owns_client else get_client()
         self.db = self.client[self.db_name]
         self.query_collection = self.db[self.query_collection_name]
         self.embedding_collection = self.db[self.embedding_collection_name]
         self.annoy_collection = self.db[self.annoy_collection_name]
-        # Instantiate the Annoy search module and ChatGPT service.
-        self.searchEngine = AnnoySearch(self.annoy_index_path, self.id_map_path, self.db_name,self.annoy_collection_name) # Make sure passing NAME of db and collection
-        self.openAI = ChatGPT(self.db,self.annoy_collection_name,self.unique_field )
+        # The Annoy search engine is shared through engine_registry (see searchEngine below).
+        self.openAI = ChatGPT(self.db,self.annoy_collection_name,self.unique_field,
+                              embedding_collection_name=self.embedding_collection_name)
 
         # Also set the embedding model from config.
         self.embedding_model = EMBEDDING_MODEL
+        # Query embeddings are kept at the model's full size and shared by every collection;
+        # AnnoySearch reduces them to the collection's "dimensions" when it searches.
+        self.embedding_dimensions = EMBEDDING_DIMENSIONS
+        ensure_query_indexes(self.query_collection)
 
         logger.info("DatabaseHandler initialized with configuration: %s", self.document_type)
 
+    @property
+    def searchEngine(self):
+        """The shared AnnoySearch for this collection (reloaded by the registry when the index is rebuilt)."""
+        return get_search_engine(self.config)
+
     def truncate_text(self, text, max_tokens=MAX_TOTAL_TOKENS, model=EMBEDDING_MODEL):
         """
-        Encodes the entire text using the tokenizer for the specified model.
-        If the token count exceeds max_tokens, truncates the text.
+        Truncates the text to max_tokens tokens for the specified model.
+        See tokenizer.truncate_text.
         """
-        encoding = tiktoken.encoding_for_model(model)
-        tokens = encoding.encode(text)
-        if len(tokens) > max_tokens:
-            logger.info("Text is too long (%d tokens). Truncating to %d tokens.", len(tokens), max_tokens)
-            tokens = tokens[:max_tokens]
-            text = encoding.decode(tokens)
-        return text
+        return tokenizer.truncate_text(text, max_tokens, model)
 
     def get_openai_embedding(self, text, model=EMBEDDING_MODEL):
         """
@@ -94,31 +109,84 @@ class DatabaseHandler:
         logger.info("Embedding generated.")
         return np.array(embedding)
 
-    def get_or_create_query_embedding(self, query):
+    def get_or_create_query_embedding(self, query, text=None):
         """
-        Checks if the query embedding exists in the 'queries' collection.
-        If it exists, returns the cached embedding; otherwise, computes it,
-        stores it, and returns it.
+        Returns the embedding of a normalised query. The in-process LRU is checked first,
+        then the indexed query collection; only on a miss in both is the embedding
+        computed and stored (as packed float32). Returns None if the daily limit
+        prevents computing it.
+
+        :param query: Normalised query, the key of the cached embedding.
+        :param text: Text to embed on a miss (defaults to the query itself).
         """
-        doc = self.query_collection.find_one({"query": query})
+        key = query_embedding_cache.make_key(query, self.embedding_model, self.embedding_dimensions)
+        embedding = query_embedding_cache.get(key)
+        if embedding is not None:
+            logger.info("Using in-memory cached query embedding.")
+            return embedding
+        doc = self.query_collection.find_one(self._query_filter(query), {"embedding": 1})
         if doc and "embedding" in doc:
-            logger.info("Using cached embedding for query.")
-            embedding = doc["embedding"]
+            logger.info("Using cached query embedding.")
+            embedding = decode_embedding(doc["embedding"])
         else:
-            logger.info("Computing new embedding for query.")
-            embedding = self.openAI.get_openai_embedding(query).tolist()
-            self.query_collection.insert_one({
-                "query": query,
-                "embedding": embedding,
-                "timestamp": datetime.datetime.now()
+            embedding = self.openAI.get_openai_embedding(text or query)
+            if embedding is None:
+                return None
+            embedding = embedding.astype(np.float32)
+            self.query_collection.insert_one(self._query_document(query, embedding))
+            logger.info("Stored new query embedding in MongoDB.")
+        query_embedding_cache.put(key, embedding)
+        return embedding
+
+    def _query_filter(self, query):
+        """
+        Filter on the indexed (query, model, dimensions) fields. Entries stored before
+        the model and dimensions were recorded still match.
+        """
+        return {
+            "query": query,
+            "model": {"$in": [self.embedding_model, None]},
+            "dimensions": {"$in": [self.embedding_dimensions, None]},
+        }
+
+    def _query_document(self, query, embedding):
+        return {
+            "query": query,
+            "model": self.embedding_model,
+            "dimensions": self.embedding_dimensions,
+            "embedding": encode_embedding(embedding),
+            "timestamp": datetime.datetime.now()
+        }
+
+    def _record_results(self, query, results):
+        """
+        Remember which documents a query returned (per result collection) and count its
+        searches, so preprocess.summarize_documents can summarise the most-seen documents first.
+        """
+        try:
+            self.query_collection.update_one(self._query_filter(query), {
+                "$set": {f"results.{self.annoy_collection_name}": [doc["_id"] for doc, _ in results]},
+                "$inc": {"searches": 1},
             })
-        return np.array(embedding)
+        except Exception as e:
+            logger.error("Failed to record the results of query '%s': %s", query, e)
 
-    def process_query(self, query):
+    def _count_cached_search(self, query, results):
+        """Like _record_results for a search answered from the result cache, written in the background."""
+        query_cache.search_counter.add(self.query_collection, self._query_filter(query),
+                                       f"results.{self.annoy_collection_name}", [doc["_id"] for doc, _ in results])
+
+    def process_query(self, query, k=None, search_k=None):
         """
         Processes the query by checking usage limits, obtaining or caching its embedding,
         and searching for similar cases using the pre-built Annoy index.
-        Rephrases the query if necessary.
+        Rephrases the query if necessary. Results are served from the process-wide
+        result cache when the same (or a near-duplicate) query was answered against
+        the current index version.
+
+        :param k: Number of results (defaults to the collection's "top_k").
+        :param search_k: Annoy search_k (defaults to the collection's "search_k"); use a small
+            value for fast interactive queries and a large one for high-recall batch work.
         """
         logger.info("User query: %s", query)
 
@@ -127,42 +195,61 @@ class DatabaseHandler:
         similar_cases = None
         query_processed = True
         logger.info("Querying...")
-        current_query  = query.replace(" ", "").lower()
+        current_query  = self.normalise_query(query)
+        original_query = current_query
+
+        engine = self.searchEngine
+        cache_key = result_cache.make_key(
+            self.annoy_collection_name, current_query,
+            k or self.config.get("top_k", TOP_QUERY_RESULT),
+            self.config.get("search_k", -1) if search_k is None else search_k,
+            THRESHOLD_QUERY_SEARCH)
+        cached = result_cache.get(cache_key, engine.version)
+        if cached is not None:
+            logger.info("Returning %d cached results.", len(cached))
+            # Repeated queries are the popular ones; count them for the summary job too.
+            self._count_cached_search(original_query, cached)
+            return cached, query_processed
+        original_embedding = None
 
         while rephrase_attempt < 5 or similar_cases==0:
             if rephrase_attempt > 0:
                 logger.info("No similar cases found above threshold. Rephrasing query (attempt %d)...", rephrase_attempt + 1)
-                current_query = self.openAI.rephrase_query(query, previous_rephrases)
-                logger.info("New query: %s", current_query)
-                previous_rephrases.append(current_query)
-                query = current_query
-
-            # Check for cached query embedding.
-            existing_doc = self.query_collection.find_one({"query": current_query})
-            if existing_doc and "embedding" in existing_doc:
-                query_embedding = np.array(existing_doc["embedding"])
-                logger.info("Using cached query embedding.")
-            else:
-                query_embedding = self.openAI.get_openai_embedding(current_query)
-                document = {
-                    "query": current_query,
-                    "embedding": query_embedding.tolist(),
-                    "timestamp": datetime.datetime.now()
-                }
-                self.query_collection.insert_one(document)
-                logger.info("Stored new query embedding in MongoDB.")
-
-            logger.info("Searching in the vector database for up to %d results.", TOP_QUERY_RESULT)
-            similar_cases = self.searchEngine.search_similar(query_embedding)
+                rephrased = self.openAI.rephrase_query(self.document_type, query, previous_rephrases)
+                if not rephrased:
+                    break
+                logger.info("New query: %s", rephrased)
+                previous_rephrases.append(rephrased)
+                query = rephrased
+                current_query = self.normalise_query(rephrased)
+
+            # Cached (LRU, then MongoDB) or freshly computed query embedding; a rephrase is
+            # cached under its normalised form but embedded as written.
+            query_embedding = self.get_or_create_query_embedding(current_query, query if rephrase_attempt > 0 else None)
+            if query_embedding is None:
+                # The embedding could not be computed within the daily limit.
+                query_processed = False
+                break
+            if rephrase_attempt == 0:
+                original_embedding = query_embedding
+                cached = result_cache.get_similar(cache_key, query_embedding, engine.version)
+                if cached is not None:
+                    self._count_cached_search(original_query, cached)
+                    return cached, query_processed
+
+            logger.info("Searching in the vector database for up to %d results.", k or self.config.get("top_k", TOP_QUERY_RESULT))
+            similar_cases = engine.search_similar(query_embedding, k=k, search_k=search_k)
             if similar_cases:
                 break
             rephrase_attempt += 1
 
         if not similar_cases:
             logger.warning("No similar cases found after rephrasing 5 times.")
-            self.client.close()
             return None, query_processed
 
+        # Cache under the original query, whichever rephrasing produced the results.
+        result_cache.put(cache_key, similar_cases, engine.version, original_embedding)
+        self._record_results(original_query, similar_cases)
 
         # Log details for each similar case including similarity.
         for doc, similarity in similar_cases:
@@ -170,8 +257,97 @@ class DatabaseHandler:
                         current_query, self.unique_field, doc.get(self.unique_field), similarity)
         return similar_cases, query_processed
 
+    def process_queries(self, queries, k=None, search_k=None, max_workers=BATCH_SEARCH_THREADS):
+        """
+        Batch counterpart of process_query for offline evaluation and bulk research jobs.
+        Cached embeddings are read with one query, misses are embedded in batched requests,
+        the Annoy lookups run on a thread pool and all documents are hydrated with one fetch.
+        Queries are not rephrased in batch mode.
+
+        :param queries: List of query strings.
+        :param k: Number of results per query (defaults to the collection's "top_k").
+        :param search_k: Annoy search_k; batch jobs typically pass a large value for recall.
+        :param max_workers: Threads used for the Annoy lookups.
+        :return: (results, timings) where results[i] is the list of (document, similarity)
+            tuples for queries[i] (None if it could not be embedded) and timings maps each
+            stage to its duration in seconds.
+        """
+        timings = {}
+        started = time.perf_counter()
+        keys = [self.normalise_query(query) for query in queries]
+        unique_keys = list(dict.fromkeys(keys))
+
+        # 1. Cached embeddings: the in-process LRU, then one round trip for the rest.
+        embeddings = {}
+        for key in unique_keys:
+            embedding = query_embedding_cache.get(
+                query_embedding_cache.make_key(key, self.embedding_model, self.embedding_dimensions))
+            if embedding is not None:
+                embeddings[key] = embedding
+        pending = [key for key in unique_keys if key not in embeddings]
+        if pending:
+            lookup = self._query_filter({"$in": pending})
+            lookup["embedding"] = {"$exists": True}
+            for doc in self.query_collection.find(lookup, {"query": 1, "embedding": 1}):
+                embeddings[doc["query"]] = decode_embedding(doc["embedding"])
+                query_embedding_cache.put(
+                    query_embedding_cache.make_key(doc["query"], self.embedding_model, self.embedding_dimensions),
+                    embeddings[doc["query"]])
+        timings["cache_lookup"] = time.perf_counter() - started
+        logger.info("Batch: %d of %d distinct queries have cached embeddings.", len(embeddings), len(unique_keys))
+
+        # 2. Embed the misses in batched requests and cache them.
+        stage = time.perf_counter()
+        misses = [key for key in unique_keys if key not in embeddings]
+        if misses:
+            new_docs = []
+            for key, embedding in zip(misses, self.openAI.get_openai_embeddings(misses)):
+                if embedding is None:
+                    continue
+                embeddings[key] = embedding.astype(np.float32)
+                new_docs.append(self._query_document(key, embeddings[key]))
+                query_embedding_cache.put(
+                    query_embedding_cache.make_key(key, self.embedding_model, self.embedding_dimensions),
+                    embeddings[key])
+            if new_docs:
+                self.query_collection.insert_many(new_docs, ordered=False)
+        timings["embedding"] = time.perf_counter() - stage
+
+        # 3. Annoy lookups on a thread pool.
+        stage = time.perf_counter()
+        engine = self.searchEngine
+        searchable = [key for key in unique_keys if key in embeddings]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            hits = dict(zip(searchable, pool.map(
+                lambda key: engine.search_ids(embeddings[key], k=k, search_k=search_k), searchable)))
+        timings["search"] = time.perf_counter() - stage
+
+        # 4. Hydrate every hit with a single fetch.
+        stage = time.perf_counter()
+        docs_by_id = engine.fetch_documents_by_id({doc_id for found in hits.values() for doc_id, _ in found})
+        timings["hydrate"] = time.perf_counter() - stage
+
+        results = []
+        for key in keys:
+            if key not in hits:
+                results.append(None)
+                continue
+            results.append([(docs_by_id[doc_id], similarity) for doc_id, similarity in hits[key]
+                            if doc_id in docs_by_id])
+        timings["total"] = time.perf_counter() - started
+        logger.info("Batch of %d queries processed in %.2fs (%s).", len(queries), timings["total"],
+                    ", ".join("%s %.3fs" % item for item in timings.items() if item[0] != "total"))
+        return results, timings
+
+    @staticmethod
+    def normalise_query(query):
+        """Key under which a query's embedding is cached."""
+        return query.replace(" ", "").lower()
+
     def close(self):
-        self.client.close()
+        # The shared client outlives individual handlers; only close a private one.
+        if self._owns_client:
+            self.client.close()
 
 # For testing purposes:
 if __name__ == "__main__":
@@ -1,90 +1,333 @@
-import pickle
+import os
 import json
+import heapq
 import logging
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
-from annoy import AnnoyIndex
 from bson import ObjectId  # Needed to convert string ID to ObjectId
-from config import MONGO_URI, EMBEDDING_DIMENSIONS, THRESHOLD_QUERY_SEARCH, TOP_QUERY_RESULT
+from id_map import IdMap
+from search_backends import ExactBackend, load_backend, index_version
+from query_cache import document_cache
+from config import (
+    MONGO_URI,
+    EMBEDDING_DIMENSIONS,
+    THRESHOLD_QUERY_SEARCH,
+    TOP_QUERY_RESULT,
+    RESULT_PROJECTION,
+    CHUNK_OVERSAMPLE,
+)
 
 # Configure logging.
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
+# Threads searching the shards of a sharded index in parallel (Annoy and NumPy release the GIL).
+SHARD_SEARCH_THREADS = os.cpu_count() or 4
+_shard_pool = None
+_shard_pool_lock = threading.Lock()
+
+def _get_shard_pool():
+    global _shard_pool
+    with _shard_pool_lock:
+        if _shard_pool is None:
+            _shard_pool = ThreadPoolExecutor(max_workers=SHARD_SEARCH_THREADS, thread_name_prefix="shard-search")
+    return _shard_pool
+
+def _reset_shard_pool():
+    # Pool threads do not survive a fork; the child starts its own on first use.
+    global _shard_pool, _shard_pool_lock
+    _shard_pool = None
+    _shard_pool_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_shard_pool)
+
+def _gevent_threadpool():
+    """
+    gevent's pool of real OS threads when threading is monkey-patched (as in app.py), else None.
+    Under the patch ThreadPoolExecutor workers are greenlets on one OS thread, so shards
+    would be searched one after another while blocking the hub for every other request.
+    """
+    try:
+        from gevent import monkey, get_hub
+    except ImportError:
+        return None
+    if not monkey.is_module_patched("threading"):
+        return None
+    pool = get_hub().threadpool
+    if pool.maxsize < SHARD_SEARCH_THREADS:
+        pool.maxsize = SHARD_SEARCH_THREADS
+    return pool
+
 class AnnoySearch:
     """Class to manage Annoy index search and MongoDB retrieval."""
     
-    def __init__(self, annoy_index_path, id_map_path, db_name, collection_name):
+    def __init__(self, annoy_index_path, id_map_path, db_name, collection_name,
+                 client_factory=None, projection=None, legacy_id_map_path=None, vector_size=None,
+                 top_k=TOP_QUERY_RESULT, search_k=-1, chunk_aggregation=None, chunk_oversample=CHUNK_OVERSAMPLE,
+                 reducer=None, backend="annoy", backend_options=None, delta_paths=None):
         """
         Initialize AnnoySearch class.
         
-        :param annoy_index_path: Path to the saved Annoy index file.
-        :param id_map_path: Path to the saved ID mapping file.
+        :param annoy_index_path: Path to the saved index file (the Annoy index, or the vector
+            file of the exact backend), or a list of paths for a sharded index.
+        :param id_map_path: Path to the saved ID mapping file, or a list with one per shard.
         :param db_name: Name of the MongoDB database.
         :param collection_name: Name of the MongoDB collection.
+        :param client_factory: Callable returning the shared MongoClient (e.g. engine_registry.get_client).
+            If omitted, a private client is opened on first use and reused.
+        :param projection: Projection applied when hydrating results (defaults to RESULT_PROJECTION).
+        :param legacy_id_map_path: Pickled ID map used when the binary one has not been written yet
+            (unsharded indexes only).
+        :param vector_size: Dimensions of the indexed vectors (defaults to the reducer's
+            dimensions, or EMBEDDING_DIMENSIONS).
+        :param top_k: Default number of neighbours per query.
+        :param search_k: Default number of nodes Annoy inspects per query (-1 = k * n_trees).
+            Higher values trade latency for recall.
+        :param chunk_aggregation: For chunked indexes (one item per chunk, id map pointing at the
+            parent), how chunk hits are combined into a parent score: "max" or "mean". None for
+            indexes with one item per document.
+        :param chunk_oversample: Chunk neighbours retrieved per requested document.
+        :param reducer: Optional dimension_reduction reducer the index was built with; query
+            embeddings are passed through it, so callers always search with full-size embeddings.
+        :param backend: Search backend holding the vectors (see search_backends): "annoy"
+            for approximate search, "exact" for brute force over a memory-mapped matrix,
+            "ivfpq" for product-quantized inverted lists.
+        :param backend_options: Backend-specific settings (search_backends.backend_options).
+        :param delta_paths: Optional (vector file, id map) of the delta index holding documents
+            embedded since the last full build (see preprocess.update_delta_index). It is
+            searched exactly next to the main index, and ignored while its files are missing.
         """
-        self.vector_size = EMBEDDING_DIMENSIONS
-        self.annoy_index_path = annoy_index_path
-        self.id_map_path = id_map_path
+        self.reducer = reducer
+        self.vector_size = vector_size or (reducer.dimensions if reducer is not None else EMBEDDING_DIMENSIONS)
+        if isinstance(annoy_index_path, (list, tuple)):
+            self.shard_paths = list(zip(annoy_index_path, id_map_path))
+        else:
+            self.shard_paths = [(annoy_index_path, id_map_path)]
+        self.annoy_index_path, self.id_map_path = self.shard_paths[0]
+        self.legacy_id_map_path = legacy_id_map_path if len(self.shard_paths) == 1 else None
         self.db_name = db_name
         self.collection_name = collection_name
-        self.index, self.id_map = self._load_annoy_index()
-        logger.info("Annoy index and ID map loaded successfully.")
+        self.client_factory = client_factory
+        self.projection = projection if projection is not None else RESULT_PROJECTION
+        self._client = None
+        self.top_k = top_k
+        self.search_k = search_k
+        self.chunk_aggregation = chunk_aggregation
+        self.chunk_oversample = chunk_oversample if chunk_aggregation else 1
+        self.backend = backend
+        self.backend_options = backend_options or {}
+        self.delta_paths = delta_paths
+        # mtime(s) of the index file(s) (and delta) at load time, used by engine_registry to detect rebuilds.
+        self.version = index_version([path for path, _ in self.shard_paths], delta_paths[0] if delta_paths else None)
+        if self.version is None:
+            raise FileNotFoundError(f"Missing index file among {[path for path, _ in self.shard_paths]}")
+        # One (index, id map) pair per shard; index and id_map are the first (only, if unsharded) one.
+        self.shards = [self._load_annoy_index(path, map_path) for path, map_path in self.shard_paths]
+        self.index, self.id_map = self.shards[0]
+        self.delta = self._load_delta()
+        logger.info("Search index (%s, %d shard(s)) and ID map loaded successfully.", self.backend, len(self.shards))
     
-    def _load_annoy_index(self):
-        """Load the Annoy index and ID mapping from disk."""
-        index = AnnoyIndex(self.vector_size, 'angular')
+    def _load_annoy_index(self, index_path, id_map_path):
+        """Load the search backend and ID mapping of one shard from disk."""
         try:
-            index.load(self.annoy_index_path)
-            logger.info("Annoy index loaded from %s", self.annoy_index_path)
+            index = load_backend(self.backend, index_path, self.vector_size, **self.backend_options)
+            logger.info("%s index loaded from %s", self.backend.capitalize(), index_path)
         except Exception as e:
-            logger.error("Failed to load Annoy index from %s: %s", self.annoy_index_path, e)
+            logger.error("Failed to load %s index from %s: %s", self.backend, index_path, e)
             raise e
         try:
-            with open(self.id_map_path, "rb") as f:
-                id_map = pickle.load(f)
-            logger.info("ID map loaded from %s", self.id_map_path)
+            id_map = IdMap.load(id_map_path, self.legacy_id_map_path)
         except Exception as e:
-            logger.error("Failed to load ID map from %s: %s", self.id_map_path, e)
+            logger.error("Failed to load ID map from %s: %s", id_map_path, e)
             raise e
         return index, id_map
+
+    def _load_delta(self):
+        """Load the delta index as an extra (exact) shard, or return None if there is none."""
+        if not self.delta_paths or not all(os.path.exists(path) for path in self.delta_paths):
+            return None
+        vectors_path, id_map_path = self.delta_paths
+        try:
+            index = ExactBackend(vectors_path, self.vector_size)
+            id_map = IdMap.load(id_map_path)
+        except Exception as e:
+            logger.error("Failed to load delta index from %s: %s", vectors_path, e)
+            return None
+        if index.get_n_items() != len(id_map):
+            # Caught between the two renames of an update; the next version check reloads it.
+            logger.warning("Delta index %s and its ID map disagree (%d vs %d items); skipping it.",
+                           vectors_path, index.get_n_items(), len(id_map))
+            return None
+        logger.info("Delta index with %d items loaded from %s", len(id_map), vectors_path)
+        return index, id_map
+
+    def unload(self):
+        """Release the memory maps of every shard."""
+        for index, _ in self._searched_shards():
+            index.unload()
+
+    def _searched_shards(self):
+        return self.shards + [self.delta] if self.delta is not None else self.shards
     
-    def search_similar(self, query_embedding):
+    def _collection(self):
+        """Return the result collection on the shared (pooled) client."""
+        if self.client_factory is not None:
+            client = self.client_factory()
+        else:
+            if self._client is None:
+                self._client = MongoClient(MONGO_URI)
+            client = self._client
+        return client[self.db_name][self.collection_name]
+
+    def search_ids(self, query_embedding, k=None, search_k=None, threshold=THRESHOLD_QUERY_SEARCH):
         """
-        Search for similar documents using the Annoy index.
+        Query the search index only, without touching MongoDB.
         
-        :param query_embedding: The embedding vector for the query.
+        :param query_embedding: The full-size embedding vector for the query.
+        :param k: Number of neighbours to retrieve (defaults to top_k).
+        :param search_k: Nodes inspected by Annoy, or lists probed by the ivfpq backend
+            (defaults to the configured search_k; -1 uses the backend's default).
+        :param threshold: Minimum similarity kept.
+        :return: A list of tuples (ObjectId, similarity_score) above the threshold, best first.
+            For chunked indexes the chunk hits are collapsed to at most k parent documents.
+        """
+        k = k or self.top_k
+        search_k = self.search_k if search_k is None else search_k
+        if self.reducer is not None:
+            query_embedding = self.reducer.transform(query_embedding)
+        neighbours = self._neighbours(query_embedding, k * self.chunk_oversample, search_k)
+        logger.info("%s index returned %d indices.", self.backend.capitalize(), len(neighbours))
+        scores = {}  # ObjectId -> similarities of its items, best first (dicts keep rank order)
+        for doc_id, similarity in neighbours:
+            scores.setdefault(doc_id, []).append(similarity)
+        hits = []
+        for doc_id, similarities in scores.items():
+            similarity = self._aggregate(similarities)
+            if similarity < threshold:
+                logger.debug("Document %s similarity %.4f below threshold %.4f", doc_id, similarity, threshold)
+                continue
+            hits.append((doc_id, similarity))
+        if self.chunk_aggregation:
+            hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits[:k]
+
+    @staticmethod
+    def _query_shard(shard, query_embedding, n, search_k):
+        """Raw (items, distances) of one shard; no logging, so it is safe on any OS thread."""
+        index, _ = shard
+        return index.get_nns_by_vector(query_embedding, n, search_k=search_k, include_distances=True)
+
+    def _hits(self, shard, indices, distances):
+        """Items of one shard as (ObjectId, similarity) pairs, best first."""
+        _, id_map = shard
+        neighbours = []
+        for idx, dist in zip(indices, distances):
+            similarity = 1 - dist / 2  # Convert angular distance to cosine similarity.
+            logger.debug("Index: %d, Distance: %.4f, Similarity: %.4f", idx, dist, similarity)
+            try:
+                doc_id = id_map[idx]
+            except Exception as e:
+                logger.error("No document ID for Annoy item %d: %s", idx, e)
+                continue
+            neighbours.append((doc_id, similarity))
+        return neighbours
+
+    def _neighbours(self, query_embedding, n, search_k):
+        """
+        The n nearest items over every shard and the delta index, best first. Shards are
+        searched in parallel; the global top n is the best n of the per-shard top n lists.
+        """
+        shards = self._searched_shards()
+        query = lambda shard: self._query_shard(shard, query_embedding, n, search_k)
+        gevent_pool = _gevent_threadpool()
+        if gevent_pool is not None:
+            # Annoy and NumPy release the GIL: the shards run in parallel on OS threads
+            # and only this greenlet waits, not the whole hub (even for a single shard).
+            raw = gevent_pool.map(query, shards)
+        elif len(shards) == 1:
+            raw = [query(shards[0])]
+        else:
+            raw = list(_get_shard_pool().map(query, shards))
+        per_shard = [self._hits(shard, indices, distances) for shard, (indices, distances) in zip(shards, raw)]
+        if len(shards) == 1:
+            return per_shard[0]
+        return heapq.nlargest(n, itertools.chain.from_iterable(per_shard), key=lambda hit: hit[1])
+
+    def _aggregate(self, similarities):
+        """Score of a document from the similarities of its retrieved items (chunks)."""
+        if self.chunk_aggregation == "mean":
+            return sum(similarities) / len(similarities)
+        return similarities[0]  # "max": items arrive best first.
+
+    def fetch_documents(self, hits, projection=None):
+        """
+        Hydrate search hits with a single $in query, keeping the order of the hits.
+        
+        :param hits: A list of tuples (ObjectId, similarity_score).
+        :param projection: Optional projection overriding the configured one.
         :return: A list of tuples (document, similarity_score).
         """
-        logger.info("Searching for similar documents...")
-        indices, distances = self.index.get_nns_by_vector(query_embedding, TOP_QUERY_RESULT, include_distances=True)
-        logger.info("Annoy returned %d indices.", len(indices))
+        if not hits:
+            return []
+        docs_by_id = self.fetch_documents_by_id([doc_id for doc_id, _ in hits], projection)
         results = []
+        for doc_id, similarity in hits:
+            doc = docs_by_id.get(doc_id)
+            if doc is None:
+                logger.warning("No document found for ID %s", doc_id)
+                continue
+            results.append((doc, similarity))
+        return results
+
+    def fetch_documents_by_id(self, doc_ids, projection=None):
+        """
+        Fetch many documents with a single $in query. With the configured projection the
+        documents go through the process-wide document cache, and only misses are queried.
         
-        # Connect to MongoDB.
-        client = MongoClient(MONGO_URI)
-        db = client[self.db_name]
-        collection = db[self.collection_name]
+        :return: A dict {ObjectId: document}; ids that no longer exist are absent.
+        """
+        if not doc_ids:
+            return {}
+        if projection is not None:
+            cursor = self._collection().find({"_id": {"$in": list(doc_ids)}}, projection)
+            return {doc["_id"]: doc for doc in cursor}
+        namespace = (self.db_name, self.collection_name)
+        docs = document_cache.get_many(namespace, doc_ids)
+        missing = [doc_id for doc_id in doc_ids if doc_id not in docs]
+        if missing:
+            fetched = list(self._collection().find({"_id": {"$in": missing}}, self.projection))
+            document_cache.put_many(namespace, fetched)
+            docs.update((doc["_id"], doc) for doc in fetched)
+        return docs
+
+    def fetch_document(self, doc_id, projection=None):
+        """
+        Load a single document, e.g. to fetch fields deferred by the result projection
+        once a user opens the result.
         
-        for idx, dist in zip(indices, distances):
-            similarity = 1 - dist / 2  # Convert angular distance to cosine similarity.
-            logger.debug("Index: %d, Distance: %.4f, Similarity: %.4f", idx, dist, similarity)
-            if similarity >= THRESHOLD_QUERY_SEARCH:
-                try:
-                    # Convert stored string ID to ObjectId.
-                    doc_id = ObjectId(self.id_map[idx])
-                except Exception as e:
-                    logger.error("Error converting ID %s to ObjectId: %s", self.id_map[idx], e)
-                    continue
-                doc = collection.find_one({"_id": doc_id}, {"embedding": 0})  # Exclude embedding field.
-                if doc:
-                    results.append((doc, similarity))
-                    logger.debug("Found document with ID %s, similarity %.4f", self.id_map[idx], similarity)
-                else:
-                    logger.warning("No document found for ID %s", self.id_map[idx])
-            else:
-                logger.debug("Index %d similarity %.4f below threshold %.4f", idx, similarity, THRESHOLD_QUERY_SEARCH)
+        :param doc_id: ObjectId (or its string form) of the document.
+        :param projection: Optional projection; by default everything but the embedding.
+        """
+        if isinstance(doc_id, str):
+            doc_id = ObjectId(doc_id)
+        return self._collection().find_one({"_id": doc_id}, projection or {"embedding": 0})
+
+    def search_similar(self, query_embedding, projection=None, k=None, search_k=None):
+        """
+        Search for similar documents using the Annoy index.
+        Hits below the threshold are dropped before any I/O, and the remaining
+        documents are fetched in one round trip over the shared client.
         
-        client.close()
-        results.sort(key=lambda x: x[1], reverse=True)
+        :param query_embedding: The embedding vector for the query.
+        :param projection: Optional projection overriding the configured one.
+        :param k: Number of neighbours to retrieve (defaults to top_k).
+        :param search_k: Annoy search_k; small for fast interactive queries, large for high recall.
+        :return: A list of tuples (document, similarity_score).
+        """
+        logger.info("Searching for similar documents...")
+        results = self.fetch_documents(self.search_ids(query_embedding, k=k, search_k=search_k), projection)
         logger.info("Search complete. %d documents returned.", len(results))
         return results
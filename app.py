@@ -1,12 +1,14 @@
 from gevent import monkey, spawn, kill
 monkey.patch_all()
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, session, jsonify, stream_with_context
 from DatabaseHandler import DatabaseHandler  # Your DatabaseHandler class
 from openai_service import ChatGPT
-from pymongo import MongoClient
-from config import COLLECTION,MONGO_URI,DB_NAME  # This contains your US_CONSITITON_SET, AUS_LAW_SET, etc.
+from engine_registry import get_database, get_search_engine, preload_search_engines
+from summary_prefetch import prefetch_summaries, get_summary, stream_summary
+from config import COLLECTION,PRELOAD_SEARCH_ENGINES,SUMMARY_PREFETCH_AHEAD,SUMMARY_PREFETCH_BUDGET,STREAM_SUMMARIES  # This contains your US_CONSITITON_SET, AUS_LAW_SET, etc.
 from flask_session import Session
 from bson import ObjectId
+import json
 import logging
 
 import uuid
@@ -14,9 +16,9 @@ app = Flask(__name__)
 app.config['SESSION_TYPE'] = 'filesystem'
 app.secret_key = 'ambre'
 Session(app)
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-# Instantiate the DatabaseHandler and ChatGPT service.
+# Search engines and the MongoDB client are shared process-wide through engine_registry.
+if PRELOAD_SEARCH_ENGINES:
+    preload_search_engines()
 
 # Configure logging.
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -32,6 +34,70 @@ def serialize_results(results):
         serialized.append((case, similarity))
     return serialized
 
+def result_ids(pairs):
+    """(id, similarity) pairs of the session; sessions written before results were stored as ids hold whole documents."""
+    return [(doc["_id"] if isinstance(doc, dict) else doc, similarity) for doc, similarity in pairs]
+
+def load_cases(pairs):
+    """
+    Documents of (id, similarity) pairs kept in the session, in order, loaded through the
+    engine's shared document cache and serialized like search results.
+    """
+    config = COLLECTION[session['collection']]
+    pairs = result_ids(pairs)
+    docs_by_id = get_search_engine(config).fetch_documents_by_id([ObjectId(doc_id) for doc_id, _ in pairs])
+    cases = []
+    for doc_id, similarity in pairs:
+        doc = docs_by_id.get(ObjectId(doc_id))
+        if doc is None:
+            logger.warning("Result %s no longer exists.", doc_id)
+            doc = {"_id": doc_id}
+        cases.append((doc, similarity))
+    return serialize_results(cases)
+
+def current_case():
+    """The (case, similarity) the session is on, its position and the result count, or None past the end."""
+    results = session.get('results')
+    current_idx = session.get('current_idx', 0)
+    if not results or current_idx >= len(results):
+        return None
+    case, similarity = load_cases([results[current_idx]])[0]
+    return case, similarity, current_idx, len(results)
+
+def result_chat_service():
+    """ChatGPT on the result collection of the session, so summaries (and deferred text) use it."""
+    config = COLLECTION[session['collection']]
+    return ChatGPT(get_database(), config["annoy_collection_name"], config.get("unique_index", "title"),
+                   embedding_collection_name=config["embedding_collection_name"])
+
+def prefetch_next_summaries(results, start):
+    """Summarise the results from `start` on in background greenlets, within the session's budget."""
+    prefetched = set(session.get('prefetched', []))
+    upcoming = [(doc_id, similarity) for doc_id, similarity in result_ids(results[start:start + SUMMARY_PREFETCH_AHEAD])
+                if doc_id not in prefetched]
+    budget = SUMMARY_PREFETCH_BUDGET - session.get('prefetch_count', 0)
+    if not upcoming or budget <= 0:
+        return
+    started = prefetch_summaries(result_chat_service(), [case for case, _ in load_cases(upcoming)], budget)
+    if started:
+        session['prefetched'] = list(prefetched.union(started))
+        session['prefetch_count'] = session.get('prefetch_count', 0) + len(started)
+
+RESULT_KEYS = ('results', 'result_set', 'current_idx', 'prefetched', 'prefetch_count')
+
+@app.before_request
+def drop_results_without_collection():
+    """
+    Sessions from before the collection was stored hold result ids without saying which
+    collection they belong to; rather than guess, forget them and send the user back to search.
+    """
+    if 'results' in session and session.get('collection') not in COLLECTION:
+        logger.info("Session results have no collection; clearing them.")
+        for key in RESULT_KEYS:
+            session.pop(key, None)
+        if request.endpoint in ('result', 'next_result', 'more_details'):
+            return redirect(url_for('index'))
+
 @app.context_processor
 def inject_document_type():
     # Get document type from the session (or a default value)
@@ -40,7 +106,7 @@ def inject_document_type():
 
 @app.route('/', methods=['GET'])
 def index():
-    chat_service = ChatGPT(db)
+    chat_service = ChatGPT(get_database())
     allowed, count = chat_service.can_search_today()  # Returns (True/False, current count)
     return render_template('index.html', configurations=COLLECTION, search_allowed=allowed, search_count=count)
 @app.route('/cancel', methods=['POST'])
@@ -60,8 +126,9 @@ def cancelled():
     return render_template('base.html', error="Search cancelled.", show_home=True)
 @app.route('/search', methods=['POST'])
 def search():
-    chat_service = ChatGPT(db)
-    if not chat_service.can_search_today():  # call the method with parentheses
+    chat_service = ChatGPT(get_database())
+    allowed, _ = chat_service.can_search_today()  # Served from the process' quota bucket
+    if not allowed:
         return render_template('base.html', error="Reached the limit of the search today. Please try again tomorrow.", show_home=True)
 
     query = request.form.get('query')
@@ -73,8 +140,9 @@ def search():
     
     # Save the selected document type in the session.
     session['document_type'] = COLLECTION[config_key]["document_type"]
+    session['collection'] = config_key
     
-    # Process the query using the updated backend function.
+    # Process the query; the handler reuses the shared engine and client for this collection.
     db_handler = DatabaseHandler(COLLECTION[config_key])
     results, query_processed = db_handler.process_query(query)
     
@@ -82,12 +150,18 @@ def search():
         return render_template('index.html', error="Daily search limit reached. Please try again tomorrow.")
     if not results:
         session.pop('results', None)
+        session.pop('result_set', None)
         session.pop('current_idx', None)
         return render_template('result.html', error="No cases matched your query sufficiently.")
     
-    # Convert ObjectIds to strings before storing in the session.
-    session['results'] = serialize_results(results)
+    # The session keeps only (id, similarity) pairs; pages load the documents through the
+    # shared document cache, which the search has just filled.
+    session['results'] = [(str(doc["_id"]), similarity) for doc, similarity in results]
+    session['result_set'] = uuid.uuid4().hex
     session['current_idx'] = 0
+    session['prefetched'] = []
+    # Start on the first summaries now; /result waits for them instead of requesting them again.
+    prefetch_next_summaries(session['results'], 0)
     return redirect(url_for('result'))
 
 
@@ -102,31 +176,68 @@ def privacy():
 
 @app.route('/result', methods=['GET'])
 def result():
-    results = session.get('results')
-    current_idx = session.get('current_idx', 0)
-    if not results or current_idx >= len(results):
+    current = current_case()
+    if current is None:
         return render_template('result.html', error="No more cases available. Please enter a new query.")
     
-    case, similarity = results[current_idx]
-    # Instantiate ChatGPT using the global database (MongoClient remains open).
-    chat_service = ChatGPT(db)
-    summary = chat_service.summarize_cases(case)
-    return render_template('result.html', summary=summary, similarity=similarity, idx=current_idx+1, total=len(results))
+    case, similarity, current_idx, total = current
+    if STREAM_SUMMARIES and not case.get("summary"):
+        # Render at once; the page fills the summary in from /result/stream.
+        summary = None
+    else:
+        summary = get_summary(result_chat_service(), case)
+    return render_template('result.html', summary=summary, similarity=similarity, idx=current_idx+1, total=total,
+                           summary_stream_url=url_for('result_stream', result_set=session.get('result_set'), idx=current_idx))
+
+def sse_event(event, data):
+    """One server-sent event; data is JSON encoded so newlines in the text survive."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/result/stream', methods=['GET'])
+def result_stream():
+    """
+    Server-sent events with the summary of the current result: "summary" events carry the
+    text as it is generated, and a final "done" event the complete summary (empty if none
+    could be generated). A stored summary arrives in a single event straight away.
+    """
+    results = session.get('results')
+    # The page names the result it was rendered for, so another tab paging on does not change it.
+    idx = request.args.get('idx', session.get('current_idx', 0), type=int)
+    stale = request.args.get('result_set', session.get('result_set')) != session.get('result_set')
+    if not results or stale or not 0 <= idx < len(results):
+        return Response(sse_event("done", ""), mimetype="text/event-stream")
+    case = load_cases([results[idx]])[0][0]
+    chat_service = result_chat_service()
+
+    def events():
+        pieces = []
+        for piece in stream_summary(chat_service, case):
+            pieces.append(piece)
+            yield sse_event("summary", piece)
+        yield sse_event("done", "".join(pieces).strip())
+
+    # No buffering by proxies (nginx), so every piece reaches the browser as it is produced.
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route('/next', methods=['GET'])
 def next_result():
     if 'results' in session:
         session['current_idx'] = session.get('current_idx', 0) + 1
+        prefetch_next_summaries(session['results'], session['current_idx'])
     return redirect(url_for('result'))
 
 @app.route('/more', methods=['GET'])
 def more_details():
-    results = session.get('results')
-    current_idx = session.get('current_idx', 0)
-    if not results or current_idx >= len(results):
+    current = current_case()
+    if current is None:
         return redirect(url_for('result'))
     
-    case, similarity = results[current_idx]
+    case, similarity, _, _ = current
+    if "text" not in case:
+        # Fields deferred by the result projection are loaded only when details are opened.
+        config = COLLECTION[session['collection']]
+        case = serialize_results([(get_search_engine(config).fetch_document(case["_id"]) or case, similarity)])[0][0]
     # Build details dictionary excluding '_id' and 'map_id'
     details = { key: value for key, value in case.items() if key not in ["_id", "map_id"] }
     return render_template('details.html', details=details)
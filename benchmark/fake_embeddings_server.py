@@ -0,0 +1,85 @@
+import json
+import time
+import zlib
+import logging
+import argparse
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import EMBEDDING_DIMENSIONS
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def fake_embedding(text, dimensions):
+    """Deterministic unit vector for a text, so repeated runs produce identical embeddings."""
+    rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+    vector = rng.standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeEmbeddingsHandler(BaseHTTPRequestHandler):
+    """Answers POST /embeddings like the OpenAI API, optionally simulating latency and rate limits."""
+
+    dimensions = EMBEDDING_DIMENSIONS
+    latency = 0.0
+    rate_limit_every = 0
+    _requests = 0
+    _lock = threading.Lock()
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/embeddings"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        with self._lock:
+            FakeEmbeddingsHandler._requests += 1
+            request_number = FakeEmbeddingsHandler._requests
+        if self.rate_limit_every and request_number % self.rate_limit_every == 0:
+            self._reply(429, {"error": {"message": "Rate limit reached (simulated).", "type": "requests"}},
+                        {"retry-after": "0.5"})
+            return
+        time.sleep(self.latency)
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions") or self.dimensions
+        self._reply(200, {
+            "object": "list",
+            "model": body.get("model"),
+            "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text, dimensions)}
+                     for i, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        })
+
+    def _reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI embeddings endpoint. "
+                                                 "Point OPENAI_BASE_URL at http://HOST:PORT/v1/ to use it.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds added to every request")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every Nth request with HTTP 429")
+    args = parser.parse_args()
+    FakeEmbeddingsHandler.latency = args.latency
+    FakeEmbeddingsHandler.rate_limit_every = args.rate_limit_every
+    server = ThreadingHTTPServer((args.host, args.port), FakeEmbeddingsHandler)
+    logger.info("Fake embeddings endpoint on http://%s:%d/v1/", args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
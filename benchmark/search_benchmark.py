@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import numpy as np
+from annoy import AnnoyIndex
+from bson import ObjectId
+from annoySearch import AnnoySearch
+from id_map import IdMapWriter, ID_WIDTH
+from embedding_codec import decode_embedding
+from search_backends import VectorFileWriter, BACKENDS
+from ivfpq import build_ivfpq, codes_path_for
+from dimension_reduction import NativeReducer, PCAReducer, PCA_SAMPLE_SIZE, REDUCTIONS
+from config import MONGO_URI, COLLECTION, EMBEDDING_DIMENSIONS, TOP_QUERY_RESULT, PQ_SUBVECTORS
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+DEFAULT_TREES = [10, 100, 1000]
+DEFAULT_SEARCH_K = [-1, 1000, 10000, 100000]
+DEFAULT_NPROBE = [4, 16, 64]
+
+
+def normalise(matrix):
+    """Return a float32 copy of the rows scaled to unit length."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def perturbed_queries(vectors, count, seed=1):
+    """
+    Queries drawn near random corpus points, so neighbours are meaningful
+    rather than uniformly distant.
+    """
+    rng = np.random.default_rng(seed)
+    anchors = vectors[rng.integers(0, len(vectors), count)]
+    noise = rng.standard_normal(anchors.shape, dtype=np.float32) * (0.5 / np.sqrt(vectors.shape[1]))
+    return normalise(anchors + noise)
+
+
+def synthetic_fixture(size, queries, dimensions, seed=0):
+    """Random unit vectors with fresh ObjectIds and perturbed queries."""
+    rng = np.random.default_rng(seed)
+    vectors = normalise(rng.standard_normal((size, dimensions), dtype=np.float32))
+    ids = np.frombuffer(b"".join(ObjectId().binary for _ in range(size)), dtype=np.uint8).reshape(size, ID_WIDTH)
+    return {"vectors": vectors, "ids": ids, "queries": perturbed_queries(vectors, queries)}
+
+
+def load_fixture(path):
+    """Load a fixture written by --export-fixture (or any npz with vectors, ids and optional queries)."""
+    data = np.load(path)
+    fixture = {"vectors": normalise(data["vectors"]), "ids": data["ids"]}
+    if "queries" in data:
+        fixture["queries"] = normalise(data["queries"])
+    return fixture
+
+
+def export_fixture(config, path, max_docs=None, max_queries=1000):
+    """Dump a collection's embeddings and stored query embeddings into an npz fixture for offline runs."""
+    from pymongo import MongoClient
+    with MongoClient(MONGO_URI) as client:
+        db = client[config["db_name"]]
+        cursor = db[config["embedding_collection_name"]].find(
+            {"embedding": {"$exists": True}}, {"embedding": 1}).sort("_id", 1)
+        if max_docs:
+            cursor = cursor.limit(max_docs)
+        vectors, ids = [], []
+        for doc in cursor:
+            vectors.append(decode_embedding(doc["embedding"]))
+            ids.append(np.frombuffer(doc["_id"].binary, dtype=np.uint8))
+        queries = [decode_embedding(doc["embedding"])
+                   for doc in db[config["query_collection_name"]].aggregate([
+                       {"$match": {"embedding": {"$exists": True}}},
+                       {"$sample": {"size": max_queries}},
+                       {"$project": {"embedding": 1}},
+                   ])]
+    fixture = {"vectors": np.vstack(vectors), "ids": np.vstack(ids)}
+    if queries:
+        fixture["queries"] = np.vstack(queries)
+    np.savez(path, **fixture)
+    logger.info("Exported %d vectors and %d queries to %s.", len(vectors), len(queries), path)
+
+
+def exact_top_k(vectors, queries, k, block=256):
+    """Brute-force ground truth: row indices of the k most cosine-similar vectors per query."""
+    k = min(k, len(vectors))
+    truth = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), block):
+        sims = queries[start:start + block] @ vectors.T
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+        truth[start:start + block] = np.take_along_axis(top, order, axis=1)
+    return truth
+
+
+def make_reducer(vectors, dimensions, reduction):
+    """Reducer for a benchmark run, or None to index the vectors at full size."""
+    if not dimensions or dimensions >= vectors.shape[1]:
+        return None
+    if reduction == "pca":
+        sample = vectors[np.random.default_rng(0).permutation(len(vectors))[:PCA_SAMPLE_SIZE]]
+        return PCAReducer.fit(sample, dimensions)
+    return NativeReducer(dimensions)
+
+
+def build_index(fixture, n_trees, directory, vectors=None, backend="annoy", pq_subvectors=PQ_SUBVECTORS):
+    """
+    Build a throwaway index and id map for the fixture.
+
+    :param vectors: Vectors to index instead of the fixture's own (e.g. reduced ones).
+    :param backend: "annoy" builds n_trees trees; "exact" writes the vector file and "ivfpq"
+        trains on it (n_trees is ignored for both).
+    :return: (index path, id map path, seconds, backend options for AnnoySearch).
+    """
+    vectors = fixture["vectors"] if vectors is None else vectors
+    name = f"bench_{backend}_{n_trees}_{vectors.shape[1]}"
+    vectors_path = os.path.join(directory, name + "_vectors.bin")
+    index_path = {"annoy": name + ".ann", "exact": name + "_vectors.bin", "ivfpq": name + "_ivfpq.npz"}[backend]
+    index_path = os.path.join(directory, index_path)
+    id_map_path = os.path.join(directory, name + "_id_map.bin")
+    started = time.perf_counter()
+    if backend in ("exact", "ivfpq"):
+        index = VectorFileWriter(vectors_path, vectors.shape[1])
+    else:
+        index = AnnoyIndex(vectors.shape[1], 'angular')
+    with IdMapWriter(id_map_path) as id_map:
+        for i, (vector, raw_id) in enumerate(zip(vectors, fixture["ids"])):
+            index.add_item(i, vector)
+            id_map.append(ObjectId(raw_id.tobytes()))
+    if backend in ("exact", "ivfpq"):
+        index.close()
+        if backend == "ivfpq":
+            build_ivfpq(vectors_path, vectors.shape[1], index_path, n_subvectors=pq_subvectors)
+    else:
+        index.build(n_trees, n_jobs=-1)
+        index.save(index_path)
+        index.unload()
+    options = {"vectors_path": vectors_path} if backend == "ivfpq" else {}
+    return index_path, id_map_path, time.perf_counter() - started, options
+
+
+def run_queries(engine, queries, k, search_k, hydrate):
+    """Run every query once; returns (per-query hit id lists, per-query latencies in seconds)."""
+    hits, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        found = engine.search_ids(query, k=k, search_k=search_k, threshold=0.0)
+        if hydrate:
+            engine.fetch_documents(found)
+        latencies.append(time.perf_counter() - started)
+        hits.append([doc_id for doc_id, _ in found])
+    return hits, np.asarray(latencies)
+
+
+def recall_at_k(hits, truth, row_of):
+    """Mean fraction of the exact top-k found by the approximate search."""
+    scores = []
+    for found, expected in zip(hits, truth):
+        rows = {row_of[doc_id] for doc_id in found if doc_id in row_of}
+        scores.append(len(rows.intersection(expected.tolist())) / len(expected))
+    return float(np.mean(scores)) if scores else 0.0
+
+
+def run_benchmark(fixture, config, trees=DEFAULT_TREES, search_ks=DEFAULT_SEARCH_K,
+                  k=TOP_QUERY_RESULT, hydrate=False, warmup=10, reducer=None, backends=("annoy",),
+                  nprobes=DEFAULT_NPROBE, pq_subvectors=PQ_SUBVECTORS):
+    """
+    Sweep tree counts and search_k values and report recall@k and latency per setting.
+    The exact backend is measured once; ivfpq is swept over nprobes (reported in the
+    search_k column), with the index size counting its model and codes.
+
+    :param fixture: Dict with "vectors", "ids" and "queries" arrays.
+    :param config: Collection configuration, used for hydration when hydrate is set.
+    :param hydrate: Also time fetching the documents from MongoDB (needs the collection to be reachable).
+    :param reducer: Optional dimension reducer; the index is built on reduced vectors while
+        recall is still measured against the exact full-size neighbours, so the rows show
+        what the reduction costs.
+    :param backends: Search backends to compare (see search_backends.BACKENDS).
+    :param nprobes: Lists probed per query for the ivfpq backend.
+    :return: A list of result dictionaries, one per (backend, trees, search_k).
+    """
+    queries = fixture["queries"]
+    vectors = reducer.transform_many(fixture["vectors"]) if reducer is not None else fixture["vectors"]
+    truth = exact_top_k(fixture["vectors"], queries, k)
+    row_of = {ObjectId(raw.tobytes()): i for i, raw in enumerate(fixture["ids"])}
+    client_factory = None
+    if hydrate:
+        from engine_registry import get_client
+        client_factory = get_client
+    logging.getLogger("annoySearch").setLevel(logging.WARNING)
+    logging.getLogger("id_map").setLevel(logging.WARNING)
+    logging.getLogger("search_backends").setLevel(logging.WARNING)
+
+    results = []
+    directory = tempfile.mkdtemp(prefix="annoy_bench_")
+    try:
+        settings = []
+        for backend in backends:
+            if backend == "annoy":
+                settings.extend((backend, n_trees, search_ks) for n_trees in trees)
+            elif backend == "ivfpq":
+                settings.append((backend, 0, nprobes))
+            else:
+                settings.append((backend, 0, [-1]))
+        for backend, n_trees, backend_search_ks in settings:
+            index_path, id_map_path, build_seconds, options = build_index(fixture, n_trees, directory, vectors,
+                                                                          backend, pq_subvectors)
+            index_bytes = os.path.getsize(index_path)
+            if backend == "ivfpq":
+                # The codes plus the float32 vectors the candidates are re-ranked against.
+                index_bytes += os.path.getsize(codes_path_for(index_path)) + os.path.getsize(options["vectors_path"])
+            engine = AnnoySearch(index_path, id_map_path, config["db_name"], config["annoy_collection_name"],
+                                 client_factory=client_factory, vector_size=vectors.shape[1], reducer=reducer,
+                                 backend=backend, backend_options=options)
+            run_queries(engine, queries[:warmup], k, -1, hydrate)
+            for search_k in backend_search_ks:
+                hits, latencies = run_queries(engine, queries, k, search_k, hydrate)
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+                results.append({
+                    "backend": backend,
+                    "dims": vectors.shape[1],
+                    "trees": n_trees,
+                    "search_k": search_k,
+                    "k": k,
+                    "recall": recall_at_k(hits, truth, row_of),
+                    "p50_ms": p50,
+                    "p95_ms": p95,
+                    "p99_ms": p99,
+                    "qps": len(queries) / latencies.sum(),
+                    "build_s": build_seconds,
+                    "index_mb": index_bytes / (1024 * 1024),
+                })
+            engine.unload()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def print_report(results):
+    header = f"{'backend':>8} {'dims':>5} {'trees':>6} {'search_k':>9} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'QPS':>9} {'build s':>8} {'index MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['backend']:>8} {r['dims']:>5} {r['trees']:>6} {r['search_k']:>9} {r['recall']:>9.3f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+              f"{r['p99_ms']:>8.2f} {r['qps']:>9.0f} {r['build_s']:>8.1f} {r['index_mb']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall/latency benchmark for AnnoySearch.")
+    parser.add_argument("--collection", default="US_CONSTITUTION_SET", choices=list(COLLECTION))
+    parser.add_argument("--fixture", help="npz fixture to benchmark offline")
+    parser.add_argument("--export-fixture", help="dump the collection's vectors and queries to this npz and exit")
+    parser.add_argument("--synthetic", type=int, help="benchmark N synthetic vectors instead of a collection")
+    parser.add_argument("--dimensions", type=int, default=EMBEDDING_DIMENSIONS, help="dimensions of synthetic vectors")
+    parser.add_argument("--max-docs", type=int, help="limit the documents read from MongoDB")
+    parser.add_argument("--queries", type=int, default=200, help="number of queries to run")
+    parser.add_argument("--trees", type=int, nargs="+", default=DEFAULT_TREES)
+    parser.add_argument("--search-k", type=int, nargs="+", default=DEFAULT_SEARCH_K)
+    parser.add_argument("-k", type=int, default=TOP_QUERY_RESULT)
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=["annoy"],
+                        help="search backends to compare")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=DEFAULT_NPROBE, help="lists probed by the ivfpq backend")
+    parser.add_argument("--pq-subvectors", type=int, default=PQ_SUBVECTORS, help="bytes per vector for the ivfpq backend")
+    parser.add_argument("--reduce-to", type=int, nargs="+", default=[0],
+                        help="also benchmark indexes reduced to these dimensions (0 = full size)")
+    parser.add_argument("--reduction", choices=REDUCTIONS, default="native", help="how --reduce-to reduces vectors")
+    parser.add_argument("--hydrate", action="store_true", help="include the MongoDB document fetch in latencies")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    config = COLLECTION[args.collection]
+
+    if args.export_fixture:
+        export_fixture(config, args.export_fixture, args.max_docs, args.queries)
+        return
+    if args.synthetic:
+        fixture = synthetic_fixture(args.synthetic, args.queries, args.dimensions)
+    elif args.fixture:
+        fixture = load_fixture(args.fixture)
+    else:
+        path = os.path.join(tempfile.gettempdir(), f"{args.collection}_bench.npz")
+        export_fixture(config, path, args.max_docs, args.queries)
+        fixture = load_fixture(path)
+    if "queries" not in fixture:
+        # No stored user queries: perturb corpus vectors instead.
+        fixture["queries"] = perturbed_queries(fixture["vectors"], args.queries)
+    fixture["queries"] = fixture["queries"][:args.queries]
+    logger.info("Benchmarking %d vectors x %d dims with %d queries.",
+                len(fixture["vectors"]), fixture["vectors"].shape[1], len(fixture["queries"]))
+
+    results = []
+    for dimensions in args.reduce_to:
+        reducer = make_reducer(fixture["vectors"], dimensions, args.reduction)
+        results.extend(run_benchmark(fixture, config, args.trees, args.search_k, args.k, args.hydrate,
+                                     reducer=reducer, backends=args.backends, nprobes=args.nprobe,
+                                     pq_subvectors=args.pq_subvectors))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,49 @@ from dotenv import load_dotenv
 from pymongo import MongoClient
 load_dotenv()  # Load variables from .env
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") # Optional, e.g. a local fake endpoint for testing
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
 CHATMODEL="gpt-4o"
 EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS"))
+EMBEDDING_STORAGE_FORMAT = os.getenv("EMBEDDING_STORAGE_FORMAT", "float32") # How embeddings are stored in MongoDB: "float32" or "float16" (packed binary) or "list" (legacy doubles)
 THRESHOLD_QUERY_SEARCH = 0.45 # Threshold of the cosine simialrity of the search
 TOP_QUERY_RESULT= 10 # Number of query retiriveted at once
+RESULT_PROJECTION = {"embedding": 0} # Fields fetched for search results (override per collection with "result_projection")
 LIMIT=10000 # Limit of request per day
+QUOTA_BLOCK_SIZE = int(os.getenv("QUOTA_BLOCK_SIZE", "20")) # Requests each process reserves from the daily limit at a time
+QUOTA_FLUSH_INTERVAL = int(os.getenv("QUOTA_FLUSH_INTERVAL", "5")) # Seconds between background writes of the request count
+SUMMARY_PREFETCH_AHEAD = int(os.getenv("SUMMARY_PREFETCH_AHEAD", "3")) # Upcoming results whose summaries are generated in the background
+SUMMARY_PREFETCH_BUDGET = int(os.getenv("SUMMARY_PREFETCH_BUDGET", "20")) # Summaries prefetched per user session at most
+STREAM_SUMMARIES = os.getenv("STREAM_SUMMARIES", "false").lower() == "true" # Render /result without waiting for the summary; the page streams it from /result/stream
+SUMMARY_PREFETCH_WAIT = 30 # Seconds /result waits for a summary being prefetched before requesting it itself
+ANNOY_TREE_COUNT = int(os.getenv("ANNOY_TREE_COUNT", "1000")) # Trees per index (override per collection with "annoy_tree_count")
+ANNOY_BUILD_JOBS = int(os.getenv("ANNOY_BUILD_JOBS", "-1")) # Threads used to build the trees, -1 uses every core
+ANNOY_ON_DISK_BUILD = os.getenv("ANNOY_ON_DISK_BUILD", "false").lower() == "true" # Build straight into the index file instead of RAM
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16")) # Lists probed per query by the "ivfpq" backend (override per collection with "nprobe")
+IVF_RERANK = 10 # Candidates re-ranked against the float32 vectors per requested result ("rerank")
+PQ_SUBVECTORS = 64 # Bytes per vector in "ivfpq" codes; must divide the collection's dimensions ("pq_subvectors")
+DELTA_UPDATE_INTERVAL = int(os.getenv("DELTA_UPDATE_INTERVAL", "300")) # Seconds between delta index updates of preprocess.update_delta_index --watch
+DELTA_COMPACT_ITEMS = int(os.getenv("DELTA_COMPACT_ITEMS", "50000")) # Delta index items at which it is folded into a new main index
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "800")) # Tokens per chunk for chunked collections (override per collection with "chunk_tokens")
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "100")) # Tokens shared by consecutive chunks ("chunk_overlap")
+CHUNK_OVERSAMPLE = 4 # Chunk neighbours fetched per requested document before collapsing to parents ("chunk_oversample")
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000")) # Query embeddings kept in memory per process
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "3600")) # Seconds a cached query embedding stays in memory
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1000")) # Search result lists kept in memory per process
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "3600")) # Seconds cached search results stay valid
+RESULT_CACHE_NEAR_DUPLICATE = float(os.getenv("RESULT_CACHE_NEAR_DUPLICATE", "0.98")) # Cosine above which a query reuses a cached query's results (0 disables)
+RESULT_CACHE_WINDOW = 256 # Recent query vectors compared for near-duplicates
+SEARCH_COUNT_FLUSH_INTERVAL = int(os.getenv("SEARCH_COUNT_FLUSH_INTERVAL", "30")) # Seconds between background writes of cached searches to User_queries
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", "5000")) # Result documents kept in memory per process for paging through results
+DOCUMENT_CACHE_TTL = int(os.getenv("DOCUMENT_CACHE_TTL", "3600")) # Seconds a cached result document stays valid
+PRELOAD_SEARCH_ENGINES = os.getenv("PRELOAD_SEARCH_ENGINES", "false").lower() == "true" # Load every index at app startup instead of on first query
 AUSLEGAL_DOCUMENT_PATH = os.getenv("AUSLEGAL_DOCUMENT_PATH")
 USCON_DOCUMENT_PATH = os.getenv("USCON_DOCUMENT_PATH") 
 DB_NAME = "ai_rag_db"
 QUERY_COLLECTION_NAME = "User_queries"
+JOB_COLLECTION_NAME = "jobs" # Checkpoints of long-running preprocessing jobs
+DEAD_LETTER_COLLECTION_NAME = "job_dead_letters" # Documents a job failed to process
   # For Dataset
 COLLECTION = {
     "US_CONSTITUTION_SET": {
@@ -23,9 +55,16 @@ COLLECTION = {
         "embedding_collection_name": "us_constitution_embedding",
         "annoy_collection_name": "us_constitution_annoy",
         "annoy_index_path": "./annoy/usc.ann",
-        "id_map_path": "./annoy/usc_id_map.pkl",
+        "id_map_path": "./annoy/usc_id_map.bin",
+        "legacy_id_map_path": "./annoy/usc_id_map.pkl",
         "document_type": "US Constitution",  # Type of the document
-        "unique_index": "title"
+        "unique_index": "title",
+        "top_k": TOP_QUERY_RESULT,  # Default results per query
+        "search_k": -1,  # Default Annoy search_k (-1 = top_k * trees); raise per query for high recall
+        "dimensions": EMBEDDING_DIMENSIONS,  # Indexed dimensions; lower it to shrink the index (rebuild required)
+        "reduction": "native",  # How embeddings are reduced to "dimensions": "native" (shortened model output) or "pca"
+        "backend": "annoy",  # Small corpus: "exact" searches a memory-mapped matrix instead of Annoy trees; switch only after rebuilding with preprocess.build_searchEngine
+        "vectors_path": "./annoy/usc_vectors.bin"  # Vector file written and read by the exact backend
     },
     "AUS_LAW_SET": {
         "db_name": DB_NAME,
@@ -33,8 +72,20 @@ COLLECTION = {
         "embedding_collection_name": "Australian_Law_2024_embedding",
         "annoy_collection_name": "Australian_Law_2024_annoy",
         "annoy_index_path": "./annoy/auslaw.ann",
-        "id_map_path": "./annoy/aus_id_map.pkl",
+        "id_map_path": "./annoy/aus_id_map.bin",
+        "legacy_id_map_path": "./annoy/aus_id_map.pkl",
         "document_type": "Australia Laws 2024",  # Type of the document
-        "unique_index": "version_id"
+        "unique_index": "version_id",
+        "top_k": TOP_QUERY_RESULT,  # Default results per query
+        "search_k": -1,  # Default Annoy search_k (-1 = top_k * trees); raise per query for high recall
+        "dimensions": EMBEDDING_DIMENSIONS,  # Indexed dimensions; lower it to shrink the index (rebuild required)
+        "reduction": "native",  # How embeddings are reduced to "dimensions": "native" (shortened model output) or "pca"
+        "backend": "annoy",  # Search backend: "annoy", "exact" (brute force, small corpora) or "ivfpq" (compressed, large corpora)
+        "shards": 1,  # Split the index into this many shards searched in parallel (annoy/exact only; rebuild required)
+        "shard_key": "_id",  # Document field hashed to pick a document's shard, e.g. "jurisdiction"
+        "result_projection": {"embedding": 0, "text": 0},  # Judgments are large; text is loaded when a result is opened
+        # Opt in to chunked search once preprocess.chunk_documents and update_embedding --chunks have run:
+        # "chunk_collection_name": "Australian_Law_2024_chunks",  # Long judgments are embedded as overlapping chunks
+        "chunk_aggregation": "max"  # Parent score from its chunk hits: "max" or "mean" (chunked collections only)
     }
 }
\ No newline at end of file
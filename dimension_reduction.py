@@ -0,0 +1,114 @@
+import os
+import logging
+import numpy as np
+from config import EMBEDDING_DIMENSIONS
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+REDUCTIONS = ("native", "pca")
+PCA_SAMPLE_SIZE = 20000  # Embeddings sampled to fit a PCA projection
+
+
+def _normalise(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class NativeReducer:
+    """
+    Shortened embeddings the way text-embedding-3 models produce them for the
+    `dimensions` parameter: the first n components, renormalised to unit length.
+    Stored full-size embeddings can therefore be reduced without re-embedding.
+    """
+
+    kind = "native"
+
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+
+    def transform_many(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        return _normalise(matrix[..., :self.dimensions])
+
+    def transform(self, vector):
+        return self.transform_many(vector)
+
+
+class PCAReducer:
+    """Projection onto the top principal components of a sample of the collection's embeddings."""
+
+    kind = "pca"
+
+    def __init__(self, mean, components):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)  # (dimensions, input dimensions)
+        self.dimensions = self.components.shape[0]
+
+    @classmethod
+    def fit(cls, vectors, dimensions):
+        """
+        Fit on a sample of (unit) embeddings via the eigendecomposition of their covariance,
+        which needs only an input-dimensions-squared matrix however large the sample is.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if dimensions > vectors.shape[1]:
+            raise ValueError("Cannot reduce %d-dimensional vectors to %d dimensions." % (vectors.shape[1], dimensions))
+        mean = vectors.mean(axis=0)
+        centred = (vectors - mean).astype(np.float64)
+        covariance = centred.T @ centred / max(len(vectors) - 1, 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:dimensions]
+        explained = eigenvalues[order].sum() / eigenvalues.sum() if eigenvalues.sum() else 0.0
+        logger.info("PCA to %d dimensions keeps %.1f%% of the variance of %d samples.",
+                    dimensions, explained * 100, len(vectors))
+        return cls(mean, eigenvectors[:, order].T)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["mean"], data["components"])
+
+    def save(self, path):
+        # Written through a file object so numpy does not append ".npz" to temporary names.
+        with open(path, "wb") as f:
+            np.savez(f, mean=self.mean, components=self.components)
+
+    def transform_many(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        return _normalise((matrix - self.mean) @ self.components.T)
+
+    def transform(self, vector):
+        return self.transform_many(vector)
+
+
+def collection_dimensions(config):
+    """Dimensions a collection is indexed and searched at."""
+    return config.get("dimensions", EMBEDDING_DIMENSIONS)
+
+
+def pca_path(config):
+    """Where a collection's PCA projection is stored: next to its Annoy index unless "pca_path" is set."""
+    return config.get("pca_path") or os.path.splitext(config["annoy_index_path"])[0] + "_pca.npz"
+
+
+def get_reducer(config):
+    """
+    Return the reducer mapping full-size embeddings to a collection's "dimensions",
+    or None when the collection uses the model's full output.
+
+    :param config: One of the dictionaries in config.COLLECTION; "reduction" selects
+        "native" (truncate and renormalise) or "pca" (load the fitted projection).
+    """
+    dimensions = collection_dimensions(config)
+    if dimensions >= EMBEDDING_DIMENSIONS:
+        return None
+    reduction = config.get("reduction", "native")
+    if reduction == "native":
+        return NativeReducer(dimensions)
+    if reduction == "pca":
+        return PCAReducer.load(pca_path(config))
+    raise ValueError("Unknown reduction %r for '%s'; expected one of %s."
+                     % (reduction, config.get("document_type"), ", ".join(REDUCTIONS)))
@@ -0,0 +1,46 @@
+import numpy as np
+from bson.binary import Binary
+from config import EMBEDDING_STORAGE_FORMAT
+
+# User-defined BSON binary subtypes marking packed little-endian vectors.
+EMBEDDING_SUBTYPE_FLOAT32 = 128
+EMBEDDING_SUBTYPE_FLOAT16 = 129
+STORAGE_FORMATS = ("float32", "float16", "list")
+
+
+def encode_embedding(embedding, storage_format=EMBEDDING_STORAGE_FORMAT):
+    """
+    Pack an embedding for MongoDB.
+
+    :param storage_format: "float32" (4 bytes per dimension), "float16" (2 bytes per
+        dimension, ~1e-3 relative error) or "list" (legacy BSON doubles).
+    """
+    if storage_format == "float32":
+        return Binary(np.asarray(embedding, dtype="<f4").tobytes(), EMBEDDING_SUBTYPE_FLOAT32)
+    if storage_format == "float16":
+        return Binary(np.asarray(embedding, dtype="<f2").tobytes(), EMBEDDING_SUBTYPE_FLOAT16)
+    if storage_format == "list":
+        return np.asarray(embedding, dtype=np.float64).tolist()
+    raise ValueError("Unknown embedding storage format: %r" % (storage_format,))
+
+
+def decode_embedding(value):
+    """
+    Return an embedding as a float32 numpy array.
+    Packed float32 binaries are wrapped without copying; float16 binaries and
+    legacy lists of doubles are converted.
+    """
+    if isinstance(value, Binary) and value.subtype == EMBEDDING_SUBTYPE_FLOAT16:
+        return np.frombuffer(value, dtype="<f2").astype(np.float32)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return np.frombuffer(value, dtype="<f4")
+    return np.asarray(value, dtype=np.float32)
+
+
+def storage_format_of(value):
+    """Return the storage format ("float32", "float16" or "list") of a stored embedding."""
+    if isinstance(value, Binary) and value.subtype == EMBEDDING_SUBTYPE_FLOAT16:
+        return "float16"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "float32"
+    return "list"
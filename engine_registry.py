@@ -0,0 +1,132 @@
+import os
+import logging
+import threading
+from pymongo import MongoClient
+from annoySearch import AnnoySearch
+from dimension_reduction import get_reducer
+from search_backends import backend_options, shard_paths, delta_paths, index_version
+from config import MONGO_URI, DB_NAME, COLLECTION, RESULT_PROJECTION, TOP_QUERY_RESULT, CHUNK_OVERSAMPLE
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# Process-wide state shared by every request, greenlet and DatabaseHandler.
+_lock = threading.RLock()
+_client = None
+_engines = {}  # annoy_index_path -> AnnoySearch
+
+
+def _reset_after_fork():
+    """
+    MongoClient is not fork-safe, so a worker forked from a preloaded master
+    must open its own client. Loaded Annoy indexes are kept: they are mmap'ed
+    read-only, so the pages stay shared between workers through the page cache.
+    """
+    global _client, _lock
+    _lock = threading.RLock()
+    _client = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_client():
+    """Return the process-wide MongoClient (pymongo pools connections internally)."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = MongoClient(MONGO_URI)
+                logger.info("Opened shared MongoDB client.")
+    return _client
+
+
+def get_database(db_name=DB_NAME):
+    """Return a database handle on the shared client."""
+    return get_client()[db_name]
+
+
+def _index_version(config):
+    """
+    Return the on-disk version (mtime, or mtimes of its shards, with the delta's mtime)
+    of a collection's index, or None if missing.
+    """
+    return index_version([path for path, _ in shard_paths(config)], delta_paths(config)[0])
+
+
+def _load_engine(config):
+    paths = shard_paths(config)
+    engine = AnnoySearch([path for path, _ in paths], [map_path for _, map_path in paths],
+                         config["db_name"], config["annoy_collection_name"],
+                         client_factory=get_client,
+                         projection=config.get("result_projection", RESULT_PROJECTION),
+                         legacy_id_map_path=config.get("legacy_id_map_path"),
+                         top_k=config.get("top_k", TOP_QUERY_RESULT),
+                         search_k=config.get("search_k", -1),
+                         chunk_aggregation=config.get("chunk_aggregation", "max") if config.get("chunk_collection_name") else None,
+                         chunk_oversample=config.get("chunk_oversample", CHUNK_OVERSAMPLE),
+                         reducer=get_reducer(config),
+                         backend=config.get("backend", "annoy"),
+                         backend_options=backend_options(config),
+                         delta_paths=delta_paths(config))
+    logger.info("Search engine for '%s' loaded (%s backend, version %s, %d dimensions).",
+                config["document_type"], engine.backend, engine.version, engine.vector_size)
+    return engine
+
+
+def get_search_engine(config):
+    """
+    Return the shared AnnoySearch for a collection configuration, loading it on first use.
+    If the index file on disk has been replaced since it was loaded (e.g. by
+    preprocess.build_searchEngine, or a delta update by preprocess.update_delta_index),
+    the new index is loaded transparently.
+
+    :param config: One of the dictionaries in config.COLLECTION.
+    """
+    key = config["annoy_index_path"]
+    engine = _engines.get(key)
+    if engine is not None:
+        version = _index_version(config)
+        if version is None or version == engine.version:
+            return engine
+        logger.info("Index file %s changed on disk; reloading.", key)
+    return reload_search_engine(config, force=False)
+
+
+def reload_search_engine(config, force=True):
+    """
+    Hot-reload hook: (re)load the index for a collection and swap it into the registry.
+    Requests already holding the previous engine finish against it; it is released
+    once the last reference is dropped.
+
+    :param force: Reload even if the on-disk version matches the loaded one.
+    """
+    key = config["annoy_index_path"]
+    with _lock:
+        current = _engines.get(key)
+        if not force and current is not None and current.version == _index_version(config):
+            return current
+        engine = _load_engine(config)
+        _engines[key] = engine
+    return engine
+
+
+def preload_search_engines(collections=COLLECTION):
+    """Eagerly load the engines of every configured collection (e.g. at app startup)."""
+    for key, config in collections.items():
+        try:
+            get_search_engine(config)
+        except Exception as e:
+            logger.error("Could not preload search engine for %s: %s", key, e)
+
+
+def close_all():
+    """Release the shared client and every loaded engine."""
+    global _client
+    with _lock:
+        _engines.clear()
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -0,0 +1,117 @@
+import os
+import pickle
+import logging
+import numpy as np
+from bson import ObjectId
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# Width of a raw ObjectId in bytes; row i of the id map file is the ObjectId of Annoy item i.
+ID_WIDTH = 12
+_EMPTY_ID = bytes(ID_WIDTH)
+
+
+class IdMap:
+    """
+    Maps Annoy item ids to document ObjectIds.
+
+    The binary format is a headerless file of fixed-width 12-byte ObjectIds,
+    memory-mapped read-only so it costs no Python objects and loads instantly.
+    A legacy pickled dict of hex strings is still accepted for migration.
+    """
+
+    def __init__(self, ids, path=None):
+        """
+        :param ids: An (N, 12) uint8 array, or a legacy dict {item_id: hex string}.
+        :param path: File the map was loaded from (for logging).
+        """
+        self._ids = ids
+        self.path = path
+        self.is_legacy = isinstance(ids, dict)
+
+    @classmethod
+    def load(cls, path, legacy_path=None):
+        """
+        Load the binary id map, falling back to a legacy pickle if only that exists.
+
+        :param path: Path of the binary id map.
+        :param legacy_path: Path of a pickled dict id map written by older builds.
+        """
+        if os.path.exists(path):
+            if os.path.getsize(path) == 0:
+                ids = np.empty((0, ID_WIDTH), dtype=np.uint8)
+            else:
+                ids = np.memmap(path, dtype=np.uint8, mode="r").reshape(-1, ID_WIDTH)
+            logger.info("ID map loaded from %s (%d ids).", path, len(ids))
+            return cls(ids, path)
+        if legacy_path and os.path.exists(legacy_path):
+            with open(legacy_path, "rb") as f:
+                ids = pickle.load(f)
+            logger.warning("Loaded legacy pickled ID map from %s; run preprocess.migrate_id_map to convert it.",
+                           legacy_path)
+            return cls(ids, legacy_path)
+        raise FileNotFoundError(f"No ID map found at {path}" + (f" or {legacy_path}" if legacy_path else ""))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, idx):
+        """Return the ObjectId of an Annoy item; raises KeyError for unknown items."""
+        if self.is_legacy:
+            return ObjectId(self._ids[idx])
+        if idx < 0 or idx >= len(self._ids):
+            raise KeyError(idx)
+        raw = self._ids[idx].tobytes()
+        if raw == _EMPTY_ID:
+            raise KeyError(idx)
+        return ObjectId(raw)
+
+    def get(self, idx, default=None):
+        try:
+            return self[idx]
+        except (KeyError, IndexError):
+            return default
+
+
+class IdMapWriter:
+    """Appends ObjectIds to a binary id map file; the n-th id written belongs to Annoy item n."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, "wb")
+
+    def append(self, doc_id):
+        """Append one id (ObjectId or hex string); None leaves a hole for an unused item id."""
+        if doc_id is None:
+            self._file.write(_EMPTY_ID)
+        else:
+            self._file.write(ObjectId(doc_id).binary)
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def convert_pickle_id_map(legacy_path, path):
+    """
+    Convert a pickled dict id map into the binary format.
+
+    :return: Number of item ids written.
+    """
+    with open(legacy_path, "rb") as f:
+        legacy = pickle.load(f)
+    size = max(legacy) + 1 if legacy else 0
+    with IdMapWriter(path) as writer:
+        for idx in range(size):
+            writer.append(legacy.get(idx))
+    logger.info("Converted %d ids from %s to %s.", len(legacy), legacy_path, path)
+    return size
@@ -0,0 +1,211 @@
+import os
+import time
+import logging
+import numpy as np
+from search_backends import ExactBackend, _normalise, _angular_distances
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+PQ_CODEWORDS = 256  # Codewords per sub-quantizer, so each code is one byte
+IVF_TRAIN_SAMPLE = 40000  # Vectors sampled to train the coarse and product quantizers
+MIN_TRAIN_PER_LIST = 39  # Fewer training vectors per list than this gives poor centroids
+KMEANS_ITERATIONS = 20
+ENCODE_BLOCK = 8192  # Vectors assigned and encoded at a time
+
+
+def _nearest(data, centroids, block=ENCODE_BLOCK):
+    """Index of the nearest centroid (Euclidean) for every row of data."""
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block):
+        chunk = np.asarray(data[start:start + block], dtype=np.float32)
+        labels[start:start + block] = np.argmin(centroid_norms - 2.0 * chunk @ centroids.T, axis=1)
+    return labels
+
+
+def _kmeans(data, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """Lloyd's k-means; empty clusters are re-seeded from random points."""
+    rng = np.random.default_rng(seed)
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        labels = _nearest(data, centroids)
+        # Per-cluster sums over the rows grouped by label (one copy of the sample).
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=k)
+        present = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[present]
+        sums = np.add.reduceat(data[order], starts, axis=0)
+        centroids[present] = sums / counts[present, None]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids
+
+
+class IVFPQModel:
+    """
+    Coarse quantizer (k-means lists) plus a product quantizer over the residuals
+    of the vectors from their list centroid.
+    """
+
+    def __init__(self, centroids, codebooks):
+        self.centroids = np.asarray(centroids, dtype=np.float32)  # (lists, dimensions)
+        self.codebooks = np.asarray(codebooks, dtype=np.float32)  # (subvectors, 256, dimensions / subvectors)
+        self.n_subvectors = self.codebooks.shape[0]
+        self.sub_size = self.codebooks.shape[2]
+
+    @classmethod
+    def train(cls, sample, n_lists, n_subvectors):
+        dimensions = sample.shape[1]
+        if dimensions % n_subvectors:
+            raise ValueError(f"{dimensions} dimensions cannot be split into {n_subvectors} sub-vectors.")
+        started = time.time()
+        centroids = _kmeans(sample, n_lists)
+        residuals = sample - centroids[_nearest(sample, centroids)]
+        sub_size = dimensions // n_subvectors
+        codebooks = np.stack([
+            _kmeans(np.ascontiguousarray(residuals[:, j * sub_size:(j + 1) * sub_size]), PQ_CODEWORDS, seed=j + 1)
+            for j in range(n_subvectors)
+        ])
+        logger.info("Trained %d lists and %d x %d codewords on %d vectors in %.1fs.",
+                    len(centroids), n_subvectors, codebooks.shape[1], len(sample), time.time() - started)
+        return cls(centroids, codebooks)
+
+    def encode(self, vectors):
+        """Return (list of every vector, (N, subvectors) uint8 codes of its residual)."""
+        lists = _nearest(vectors, self.centroids)
+        residuals = np.asarray(vectors, dtype=np.float32) - self.centroids[lists]
+        codes = np.empty((len(vectors), self.n_subvectors), dtype=np.uint8)
+        for j in range(self.n_subvectors):
+            sub = np.ascontiguousarray(residuals[:, j * self.sub_size:(j + 1) * self.sub_size])
+            codes[:, j] = _nearest(sub, self.codebooks[j])
+        return lists, codes
+
+
+def codes_path_for(model_path):
+    """The PQ codes file that belongs to an IVF-PQ model file."""
+    return os.path.splitext(model_path)[0] + "_codes.bin"
+
+
+def build_ivfpq(vectors_path, vector_size, model_path, n_lists=None, n_subvectors=64,
+                codes_path=None, train_sample=IVF_TRAIN_SAMPLE):
+    """
+    Train an IVF-PQ index on the vector file written by VectorFileWriter and write
+    its model (centroids, codebooks, list offsets and item order) and codes.
+    Codes are stored grouped by list, so probing a list reads one contiguous slice.
+
+    :param n_lists: Coarse lists; defaults to 4 * sqrt(N), capped by what the sample can train.
+    :param n_subvectors: Bytes per encoded vector; must divide vector_size.
+    :return: Number of vectors encoded.
+    """
+    codes_path = codes_path or codes_path_for(model_path)
+    vectors = ExactBackend(vectors_path, vector_size).vectors
+    count = len(vectors)
+    if count == 0:
+        raise ValueError("No vectors to index.")
+    rng = np.random.default_rng(0)
+    sample = np.asarray(vectors[np.sort(rng.choice(count, min(train_sample, count), replace=False))])
+    n_lists = n_lists or max(1, min(int(4 * np.sqrt(count)), len(sample) // MIN_TRAIN_PER_LIST))
+    model = IVFPQModel.train(sample, n_lists, n_subvectors)
+
+    started = time.time()
+    lists = np.empty(count, dtype=np.int32)
+    codes = np.empty((count, model.n_subvectors), dtype=np.uint8)
+    for start in range(0, count, ENCODE_BLOCK):
+        lists[start:start + ENCODE_BLOCK], codes[start:start + ENCODE_BLOCK] = model.encode(vectors[start:start + ENCODE_BLOCK])
+    items = np.argsort(lists, kind="stable").astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(lists, minlength=len(model.centroids))))).astype(np.int64)
+    codes[items].tofile(codes_path)
+    # Written through a file object so numpy does not append ".npz" to temporary names.
+    with open(model_path, "wb") as f:
+        np.savez(f, centroids=model.centroids, codebooks=model.codebooks, offsets=offsets, items=items)
+    logger.info("Encoded %d vectors into %d lists in %.1fs (%d bytes per vector instead of %d).",
+                count, len(model.centroids), time.time() - started, model.n_subvectors, vector_size * 4)
+    return count
+
+
+class IVFPQBackend:
+    """
+    Inverted-file index with product-quantized residuals (see search_backends for the interface).
+
+    A query probes the `nprobe` lists whose centroids are closest, scores their members
+    from the one-byte-per-subvector codes with a per-query lookup table, and re-ranks
+    the best `rerank` * n candidates exactly against the float32 vector file. Only the
+    codes of the probed lists and the re-ranked rows are paged in.
+    """
+
+    def __init__(self, path, vector_size, vectors_path, nprobe=16, rerank=10):
+        """
+        :param path: Model file written by build_ivfpq; the codes file sits next to it.
+        :param vectors_path: Float32 vector file used for re-ranking.
+        :param nprobe: Lists probed per query when search_k is not given.
+        :param rerank: Candidates re-ranked exactly per requested neighbour (0 disables re-ranking).
+        """
+        self.path = path
+        self.vector_size = vector_size
+        with np.load(path) as data:
+            self.model = IVFPQModel(data["centroids"], data["codebooks"])
+            self.offsets = data["offsets"]
+            self.items = data["items"]
+        self.centroid_norms = np.einsum("ij,ij->i", self.model.centroids, self.model.centroids)
+        codes_path = codes_path_for(path)
+        if os.path.getsize(codes_path) == 0:
+            self.codes = np.empty((0, self.model.n_subvectors), dtype=np.uint8)
+        else:
+            self.codes = np.memmap(codes_path, dtype=np.uint8, mode="r").reshape(-1, self.model.n_subvectors)
+        self.vectors = ExactBackend(vectors_path, vector_size)
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+    def get_n_items(self):
+        return len(self.items)
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=True):
+        """
+        :param search_k: Lists to probe (-1 uses the configured nprobe); more lists, higher recall.
+        """
+        if n <= 0 or not len(self.items):
+            return ([], []) if include_distances else []
+        query = _normalise(np.asarray(vector, dtype=np.float32))
+        model = self.model
+        nprobe = min(search_k if search_k > 0 else self.nprobe, len(model.centroids))
+        # Nearest centroids by Euclidean distance: argmax of q.c - |c|^2 / 2.
+        coarse = model.centroids @ query - 0.5 * self.centroid_norms
+        probed = np.argpartition(-coarse, nprobe - 1)[:nprobe]
+        # table[j, c] = inner product of the j-th query sub-vector with codeword c.
+        table = np.einsum("jcd,jd->jc", model.codebooks, query.reshape(model.n_subvectors, model.sub_size))
+        columns = np.arange(model.n_subvectors)
+        candidates, scores = [], []
+        for lst in probed:
+            start, end = self.offsets[lst], self.offsets[lst + 1]
+            if start == end:
+                continue
+            codes = np.asarray(self.codes[start:end])
+            candidates.append(self.items[start:end])
+            scores.append(model.centroids[lst] @ query + table[columns, codes].sum(axis=1))
+        if not candidates:
+            return ([], []) if include_distances else []
+        candidates = np.concatenate(candidates)
+        scores = np.concatenate(scores)
+
+        keep = min(len(candidates), max(n, n * self.rerank))
+        top = np.argpartition(-scores, keep - 1)[:keep]
+        candidates, scores = candidates[top], scores[top]
+        if self.rerank:
+            # Exact cosine for the shortlist, reading rows in file order.
+            order = np.argsort(candidates)
+            candidates = candidates[order]
+            scores = self.vectors.vectors[candidates] @ query
+        n = min(n, len(candidates))
+        best = np.argpartition(-scores, n - 1)[:n]
+        best = best[np.argsort(-scores[best])]
+        if not include_distances:
+            return candidates[best].tolist()
+        return candidates[best].tolist(), _angular_distances(scores[best]).tolist()
+
+    def unload(self):
+        self.codes = np.empty((0, self.model.n_subvectors), dtype=np.uint8)
+        self.vectors.unload()
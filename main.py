@@ -1,6 +1,7 @@
 import json
 from DatabaseHandler import DatabaseHandler
 from openai_service import ChatGPT
+from engine_registry import close_all
 from config import COLLECTION
 
 def display_more_details(case):
@@ -36,9 +37,10 @@ def main():
     print("Selected configuration details:")
     print(json.dumps(config, indent=4))
     
-    # Instantiate the DatabaseHandler and ChatGPT service.
+    # Instantiate the DatabaseHandler (shared engine and client come from engine_registry) and ChatGPT service.
     db_handler = DatabaseHandler(config)
-    chat_service = ChatGPT(db_handler.db)
+    chat_service = ChatGPT(db_handler.db, db_handler.annoy_collection_name, db_handler.unique_field,
+                           embedding_collection_name=db_handler.embedding_collection_name)
     
     last_query_results = None
     current_idx = 0
@@ -62,6 +64,9 @@ def main():
                 continue
             # Show details for the last returned case (previous index).
             case, similarity = last_query_results[current_idx - 1]
+            if "text" not in case:
+                # Load fields deferred by the result projection.
+                case = db_handler.searchEngine.fetch_document(case["_id"]) or case
             display_more_details(case)
             continue
         else:
@@ -81,7 +86,8 @@ def main():
         # Generate and display a summary for the current case.
         summary = chat_service.summarize_cases(case)
         print(f"\nSummary (Similarity: {similarity:.2f}):\n{summary}\n")
-    db_handler.close() # Close the connection
+    db_handler.close()
+    close_all() # Close the shared connection and release the loaded indexes
     print("Goodbye!")
 
 if __name__ == "__main__":
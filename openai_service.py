@@ -2,29 +2,40 @@ import openai
 import numpy as np
 import logging
 import datetime
-import tiktoken  # Ensure you have installed the tiktoken package
-from config import OPENAI_API_KEY, EMBEDDING_MODEL, LIMIT,CHATMODEL
-MAX_TOTAL_TOKENS = 8000 
+from bson import ObjectId
+from config import OPENAI_API_KEY, OPENAI_BASE_URL, EMBEDDING_MODEL, CHATMODEL
+from quota import get_quota
+from query_cache import document_cache
+import tokenizer  # Cached encodings shared with the rest of the codebase
+from tokenizer import MAX_TOTAL_TOKENS
+EMBEDDING_BATCH_SIZE = 100 # Inputs sent per embeddings request in batch mode
+SUMMARY_MAX_TOKENS = 250 # Completion tokens per case summary
 
 # Set OpenAI API key.
 openai.api_key = OPENAI_API_KEY
+if OPENAI_BASE_URL:
+    # e.g. a local fake embeddings endpoint for testing the backfill.
+    openai.base_url = OPENAI_BASE_URL
 
 # Configure logging.
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 class ChatGPT:
-    def __init__(self, db, collection_name=None,unique_field=None,preprocess=False):
+    def __init__(self, db, collection_name=None,unique_field=None,preprocess=False,embedding_collection_name=None):
         """
         Initialize ChatGPT service.
         
         :param db: MongoDB database instance (for search limits, etc.)
+        :param embedding_collection_name: Collection the annoy collection is rebuilt from; summaries
+            are stored there too so they survive index rebuilds.
         """
         self.chat_model = CHATMODEL # Chat model to use for completions
         self.embedding_model = EMBEDDING_MODEL
         self.db = db
         self.preprocess=preprocess
         self.collection_name=collection_name
+        self.embedding_collection_name = embedding_collection_name
         self.unique_field = unique_field
         
     def summarize_cases(self, case):
@@ -34,54 +45,145 @@ class ChatGPT:
             Otherwise, generates a summary, updates the document in the database,
             stores it in the case dictionary, and returns it.
             """
-            if case.get("summary"):
-                logger.info("Summary already exists for case with %s: %s", 
-                            self.unique_field, case.get(self.unique_field))
+            if self._load_summary(case):
                 return case["summary"]
 
-            context = f"text:\n{case.get('text')}"
-            prompt = (
-                f"Summarize the following case in short:\n\n"
-                f"{context}\n\nSummary:"
-            )
+            if not self.acquire_request():
+                logger.warning("Reached the daily search limit; no summary generated.")
+                return ""
 
             logger.info("Generating summary for case with %s: %s", 
                         self.unique_field, case.get(self.unique_field))
             try:
-                response = openai.chat.completions.create(
-                    model=self.chat_model,
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=250
-                )
-                summary = response.choices[0].message.content.strip()
+                summary = self.generate_summary(case.get("text"))
                 logger.info("Summary generated successfully for case with _id: %s", case.get("_id"))
             except Exception as e:
                 logger.error("Error generating summary: %s", e)
-                summary = ""
+                self.refund_request()
+                return ""
             
-            # Update the summary in the document stored in the dynamic collection.
+            if summary:
+                self._store_summary(case, summary)
+            return summary
+
+    def stream_summary(self, case):
+        """
+        Like summarize_cases, but yields the summary piece by piece as the completion
+        streams in. A stored summary is yielded at once as a single piece. The complete
+        text is saved once the stream ends, even if the consumer stops reading early.
+        """
+        if self._load_summary(case):
+            yield case["summary"]
+            return
+        if not self.acquire_request():
+            logger.warning("Reached the daily search limit; no summary generated.")
+            return
+
+        logger.info("Streaming summary for case with %s: %s", 
+                    self.unique_field, case.get(self.unique_field))
+        pieces = []
+        stream = None
+        try:
+            stream = self.generate_summary_stream(case.get("text"))
+            for piece in stream:
+                pieces.append(piece)
+                yield piece
+        except GeneratorExit:
+            # The client went away: finish the (already paid for) completion so it is stored.
             try:
-                self.db[self.collection_name].update_one(
-                    {"_id": case["_id"]},
-                    {"$set": {"summary": summary}}
-                )
-                logger.info("Updated summary in database for case with _id: %s", case.get("_id"))
+                pieces.extend(stream)
             except Exception as e:
-                logger.error("Failed to update summary in database: %s", e)
-            
-            # Also update the case dictionary locally.
-            case["summary"] = summary
-            # Increment the search count (if needed).
-            self.increment_search_count(self.can_search_today()[1])
-            return summary
+                logger.error("Error finishing streamed summary: %s", e)
+        except Exception as e:
+            logger.error("Error streaming summary: %s", e)
+            self.refund_request()
+        summary = "".join(pieces).strip()
+        if summary:
+            self._store_summary(case, summary)
+
+    def _load_summary(self, case):
+        """
+        Returns True if the case has a summary, filling it in from the database when it
+        was stored after the case was loaded (by a prefetch or preprocess.summarize_documents).
+        Also loads the text if the result projection left it out.
+        """
+        if case.get("summary"):
+            logger.info("Summary already exists for case with %s: %s", 
+                        self.unique_field, case.get(self.unique_field))
+            return True
+        if self.collection_name:
+            projection = {"summary": 1} if "text" in case else {"summary": 1, "text": 1}
+            doc = self.db[self.collection_name].find_one({"_id": self._object_id(case["_id"])}, projection) or {}
+            if doc.get("summary"):
+                case["summary"] = doc["summary"]
+                return True
+            if "text" not in case:
+                case["text"] = doc.get("text", "")
+        return False
+
+    def _store_summary(self, case, summary):
+        """Saves a summary in the document stored in the dynamic and embedding collections and in the case."""
+        try:
+            for name in (self.collection_name, self.embedding_collection_name):
+                if name:
+                    self.db[name].update_one(
+                        {"_id": self._object_id(case["_id"])},
+                        {"$set": {"summary": summary}}
+                    )
+            logger.info("Updated summary in database for case with _id: %s", case.get("_id"))
+            # Pages load results through the document cache; let them see the summary too.
+            document_cache.update((self.db.name, self.collection_name), self._object_id(case["_id"]), {"summary": summary})
+        except Exception as e:
+            logger.error("Failed to update summary in database: %s", e)
+        
+        # Also update the case dictionary locally.
+        case["summary"] = summary
+
+    @staticmethod
+    def summary_prompt(text):
+        """The chat prompt asking for a short summary of a document's text."""
+        context = f"text:\n{text}"
+        return (
+            f"Summarize the following case in short:\n\n"
+            f"{context}\n\nSummary:"
+        )
+
+    def generate_summary(self, text):
+        """
+        Generates a summary of a document's text with one chat completion, without
+        quota checks or database writes (see summarize_cases and preprocess.summarize_documents).
+        Errors from the API are raised to the caller.
+        """
+        response = openai.chat.completions.create(
+            model=self.chat_model,
+            messages=[{"role": "user", "content": self.summary_prompt(text)}],
+            max_tokens=SUMMARY_MAX_TOKENS
+        )
+        return response.choices[0].message.content.strip()
+
+    def generate_summary_stream(self, text):
+        """Generator over the pieces of a summary as the chat completion streams them."""
+        response = openai.chat.completions.create(
+            model=self.chat_model,
+            messages=[{"role": "user", "content": self.summary_prompt(text)}],
+            max_tokens=SUMMARY_MAX_TOKENS,
+            stream=True
+        )
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    @staticmethod
+    def _object_id(doc_id):
+        """Session-serialized results carry string ids; convert them back for queries."""
+        return ObjectId(doc_id) if isinstance(doc_id, str) else doc_id
 
     def rephrase_query(self,document_type, query, avoid_list):
         """
         Rephrases the input query using ChatGPT to generate a more effective version,
         while avoiding any phrases provided in avoid_list.
         """
-        query_allowed, usage = self.can_search_today()
-        if not query_allowed:
+        if not self.acquire_request():
             logger.warning("Reached the daily search limit.")
             return None
         avoid_text = ""
@@ -108,15 +210,13 @@ class ChatGPT:
             logger.error("Error rephrasing query: %s", e)
             rephrased_query = None
         
-        self.increment_search_count(usage)
         return rephrased_query
 
     def get_openai_embedding(self, text, model=EMBEDDING_MODEL):
         """
         Generates an embedding for the given text (after truncation).
         """
-        query_allowed, usage = self.can_search_today()
-        if not query_allowed:
+        if not self.acquire_request():
             logger.warning("Reached the daily search limit.")
             return None
         text = self.truncate_text(text, max_tokens=MAX_TOTAL_TOKENS, model=model)
@@ -128,26 +228,51 @@ class ChatGPT:
             )
         except Exception as e:
             logger.error("Error generating embedding: %s", e)
+            self.refund_request()
             raise e
 
         # DO NOT CHANGE THE METHOD CALL TO OPEN AI.
         embedding = response.data[0].embedding
         logger.info("Embedding generated.")
-        self.increment_search_count(usage)
         return np.array(embedding)
 
+    def get_openai_embeddings(self, texts, model=EMBEDDING_MODEL, batch_size=EMBEDDING_BATCH_SIZE, truncate=True):
+        """
+        Generates embeddings for many texts, sending up to batch_size inputs per request.
+        Each request counts once against the daily limit.
+        Pass truncate=False when the texts are already within MAX_TOTAL_TOKENS.
+
+        :return: A list of numpy arrays in the order of texts; None for texts not embedded
+            because the daily limit was reached.
+        """
+        embeddings = [None] * len(texts)
+        for start in range(0, len(texts), batch_size):
+            if not self.acquire_request():
+                logger.warning("Reached the daily search limit.")
+                break
+            batch = texts[start:start + batch_size]
+            if truncate:
+                batch = [self.truncate_text(text, max_tokens=MAX_TOTAL_TOKENS, model=model) for text in batch]
+            logger.info("Generating %d embeddings in one request...", len(batch))
+            try:
+                response = openai.embeddings.create(
+                    model=model,
+                    input=batch
+                )
+            except Exception as e:
+                logger.error("Error generating embeddings: %s", e)
+                self.refund_request()
+                raise e
+            for item in response.data:
+                embeddings[start + item.index] = np.array(item.embedding)
+        return embeddings
+
     def truncate_text(self, text, max_tokens=MAX_TOTAL_TOKENS, model=EMBEDDING_MODEL):
         """
-        Encodes the entire text using the tokenizer for the specified model.
-        If the token count exceeds max_tokens, truncates the text.
+        Truncates the text to max_tokens tokens for the specified model.
+        See tokenizer.truncate_text.
         """
-        encoding = tiktoken.encoding_for_model(model)
-        tokens = encoding.encode(text)
-        if len(tokens) > max_tokens:
-            logger.info("Text is too long (%d tokens). Truncating to %d tokens.", len(tokens), max_tokens)
-            tokens = tokens[:max_tokens]
-            text = encoding.decode(tokens)
-        return text
+        return tokenizer.truncate_text(text, max_tokens, model)
 
     def get_today_str(self):
         """Return today's date as an ISO string."""
@@ -155,33 +280,38 @@ class ChatGPT:
         logger.info("Today's date: %s", today_str)
         return today_str
 
+    def acquire_request(self):
+        """
+        Take one request from the daily quota before calling OpenAI (see quota.DailyQuota).
+        Returns False once today's limit is reached; preprocessing jobs are not limited.
+        """
+        if self.preprocess:
+            return True
+        return get_quota(self.db).try_acquire()
+
+    def refund_request(self):
+        """Give back a request taken by acquire_request that failed before reaching OpenAI."""
+        if not self.preprocess:
+            get_quota(self.db).refund()
+
     def can_search_today(self):
         """
-        Returns True if today's search count is below the given limit.
-        Also returns the current count.
+        Returns True if a request can still be made today, and today's request count.
+        Both come from the process' quota bucket, so this rarely touches MongoDB.
         """
         if not self.preprocess:
-            today = self.get_today_str()
-            record = self.db.search_limits.find_one({"date": today})
-            if record is None:
-                new_record = {"date": today, "OpenAPI_Request": 0}
-                self.db.search_limits.insert_one(new_record)
-                logger.info("Usage of today: 0.")
-                return True, 0
-            usage_today = record.get("OpenAPI_Request", 0)
+            quota = get_quota(self.db)
+            usage_today = quota.usage()
             logger.info("Usage of today: %d", usage_today)
-            return usage_today < LIMIT, usage_today
+            return quota.has_capacity(), usage_today
         return True,0
 
-    def increment_search_count(self, count):
-        """Increment today's search count by one."""
+    def increment_search_count(self, count=None):
+        """
+        Record one request made without acquire_request. The count argument is accepted
+        for compatibility and ignored; usage is flushed to MongoDB in the background.
+        """
         if not self.preprocess:
-            today = self.get_today_str()
-            new_count = count + 1  # calculate new count for logging
-            logger.info("Updated usage of today to %d.", new_count)
-            # Use $inc with 1 so that it increments by one, regardless of count
-            self.db.search_limits.update_one(
-                {"date": today},
-                {"$inc": {"OpenAPI_Request": 1}},
-                upsert=True
-            )
\ No newline at end of file
+            quota = get_quota(self.db)
+            if not quota.try_acquire():
+                logger.warning("Request made after the daily limit was reached; it is not counted.")
@@ -1,11 +1,26 @@
 import os
+import sys
 import json
-import pickle
+import time
 import logging
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient, WriteConcern
 from annoy import AnnoyIndex
-from config import MONGO_URI, EMBEDDING_DIMENSIONS, COLLECTION
+from config import (
+    MONGO_URI,
+    EMBEDDING_DIMENSIONS,
+    COLLECTION,
+    ANNOY_TREE_COUNT,
+    ANNOY_BUILD_JOBS,
+    ANNOY_ON_DISK_BUILD,
+    PQ_SUBVECTORS,
+)
+from id_map import IdMapWriter
+from embedding_codec import decode_embedding
+from search_backends import VectorFileWriter, vectors_path, shard_paths, shard_of, delta_paths, manifest_path
+from ivfpq import build_ivfpq, codes_path_for
+from dimension_reduction import NativeReducer, PCAReducer, PCA_SAMPLE_SIZE, collection_dimensions, pca_path
 
 # Configure logging.
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -13,71 +28,418 @@ logger = logging.getLogger(__name__)
 
 # Global constants.
 VECTOR_SIZE = EMBEDDING_DIMENSIONS
-ANNOY_TREE_COUNT = 1000  # Adjust based on desired accuracy
+BUILD_BATCH_SIZE = 1000  # Documents per cursor batch and per bulk insert into the annoy collection
 
-def prebuild_annoy_index(config):
-    ANNOY_INDEX_PATH = config["annoy_index_path"]
-    ID_MAP_PATH = config["id_map_path"]
-    logger.info("ANNOY_INDEX_PATH: %s", ANNOY_INDEX_PATH)
-    logger.info("ID_MAP_PATH: %s", ID_MAP_PATH)
+def _peak_memory_mb():
+    """Peak resident set size of this process in MB, or None where it cannot be measured."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in KiB elsewhere.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _flush_copies(collection, batch):
+    """Bulk insert one batch of copied documents."""
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def read_manifest(config):
+    """
+    The manifest of a collection's last full build: {"max_id": hex ObjectId of the newest
+    vector source document it indexed, "built_at": ISO timestamp}, or None if there is none.
+    """
+    try:
+        with open(manifest_path(config)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _write_manifest(config, max_id):
+    path = manifest_path(config)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"max_id": str(max_id) if max_id is not None else None,
+                   "built_at": datetime.datetime.now(datetime.timezone.utc).isoformat()}, f)
+    os.replace(path + ".tmp", path)
+
+def _remove_delta(config):
+    """Drop the delta index once a full build has folded its documents into the main index."""
+    delta_vectors_path, delta_id_map_path = delta_paths(config)
+    # The vector file goes first: engines only load a delta when both files exist.
+    for path in (delta_vectors_path, delta_id_map_path):
+        if os.path.exists(path):
+            os.remove(path)
+            logger.info("Removed delta index file %s.", path)
+
+def _fit_reducer(config, source, tmp_pca_path, sample_size=PCA_SAMPLE_SIZE):
+    """
+    Return the reducer for the configuration's "dimensions", or None for full-size vectors.
+    A PCA projection is fitted on a random sample of `source` and saved to tmp_pca_path.
+    """
+    dimensions = collection_dimensions(config)
+    if dimensions >= EMBEDDING_DIMENSIONS:
+        return None
+    if config.get("reduction", "native") != "pca":
+        return NativeReducer(dimensions)
+    sample = [decode_embedding(doc["embedding"]) for doc in source.aggregate([
+        {"$match": {"embedding": {"$exists": True}}},
+        {"$sample": {"size": sample_size}},
+        {"$project": {"embedding": 1}},
+    ], allowDiskUse=True)]
+    if not sample:
+        raise ValueError("No embeddings in '%s' to fit a PCA projection on." % source.name)
+    reducer = PCAReducer.fit(sample, dimensions)
+    reducer.save(tmp_pca_path)
+    return reducer
+
+def _reduced(emb, reducer):
+    """Decode a stored embedding and reduce it to the indexed dimensions."""
+    vector = decode_embedding(emb)
+    return reducer.transform(vector) if reducer is not None else vector
+
+class _ShardBuild:
+    """
+    Writers and files of one shard (the whole index when unsharded) during a build.
+    Everything is written to ".tmp" files and only renamed into place by commit().
+    """
+
+    def __init__(self, number, index_path, id_map_path, vector_size, backend, on_disk,
+                 vectors_path=None, ivf_lists=None, pq_subvectors=PQ_SUBVECTORS):
+        self.number = number
+        self.backend = backend
+        self.vector_size = vector_size
+        self.on_disk = on_disk
+        self.index_path = index_path
+        self.id_map_path = id_map_path
+        # The exact backend's vector file is its index; ivfpq keeps one next to its model for re-ranking.
+        self.vectors_path = index_path if backend == "exact" else vectors_path
+        self.codes_path = codes_path_for(index_path) if backend == "ivfpq" else None
+        self.ivf_lists = ivf_lists
+        self.pq_subvectors = pq_subvectors
+        if backend in ("exact", "ivfpq"):
+            # Rows are written straight to the vector file as they stream in.
+            self.index = VectorFileWriter(self.vectors_path + ".tmp", vector_size)
+        else:
+            self.index = AnnoyIndex(vector_size, 'angular')
+            if on_disk:
+                # Must be set before adding items; the index is then built inside the file.
+                self.index.on_disk_build(index_path + ".tmp")
+        self.id_map = IdMapWriter(id_map_path + ".tmp")
+
+    @property
+    def count(self):
+        return self.id_map.count
+
+    def add(self, vector, doc_id):
+        """Add one item and return its item number within the shard."""
+        i = self.id_map.count
+        self.index.add_item(i, vector)
+        self.id_map.append(doc_id)
+        return i
+
+    def build(self, n_trees, n_jobs):
+        self.id_map.close()
+        if self.backend in ("exact", "ivfpq"):
+            self.index.close()
+            if self.backend == "ivfpq":
+                build_ivfpq(self.vectors_path + ".tmp", self.vector_size, self.index_path + ".tmp",
+                            n_lists=self.ivf_lists, n_subvectors=self.pq_subvectors,
+                            codes_path=self.codes_path + ".tmp")
+        else:
+            self.index.build(n_trees, n_jobs=n_jobs)
+            if not self.on_disk:
+                self.index.save(self.index_path + ".tmp")
+            self.index.unload()
+
+    def _files(self):
+        """Final paths in commit order: the index file goes last (see commit)."""
+        files = [self.id_map_path]
+        if self.backend == "ivfpq":
+            files += [self.vectors_path, self.codes_path]
+        return files + [self.index_path]
+
+    def discard(self):
+        self.id_map.close()
+        if self.backend in ("exact", "ivfpq"):
+            self.index.close()
+        for path in self._files():
+            _remove_quietly(path + ".tmp")
+
+    def commit(self):
+        # Atomically swap the new files in. The id map goes first: running engines only
+        # reload once the index file itself changes, and then find the matching map.
+        for path in self._files():
+            os.replace(path + ".tmp", path)
+        logger.info("%s index with %d items saved to %s (ID map: %s).",
+                    self.backend.capitalize(), self.count, self.index_path, self.id_map_path)
+
+def _stream_documents(source, staging_collection, builds, route, batch_size, projection, started, reducer=None):
+    """
+    Add one item per embedded document to the build of its shard and copy the documents
+    (without their embedding) into the staging collection, one batch at a time.
+    Documents of shards that are not being rebuilt (None in builds) are skipped.
+
+    :return: Number of documents copied.
+    """
+    batch = []  # Copied documents waiting for the next bulk insert.
+    copied = streamed = 0
+    cursor = source.find(
+        {"embedding": {"$exists": True}}, projection,
+        batch_size=batch_size, no_cursor_timeout=True
+    ).sort("_id", 1)
+    with cursor:
+        for doc in cursor:
+            emb = doc.pop("embedding", None)
+            if emb is None:
+                continue
+            shard = route(doc)
+            build = builds[shard]
+            if build is None:
+                continue
+            i = build.add(_reduced(emb, reducer), doc["_id"])
+            # The document without its embedding, plus the "map_id" field ("shard:item" when sharded).
+            doc["map_id"] = str(i) if len(builds) == 1 else f"{shard}:{i}"
+            batch.append(doc)
+            streamed += 1
+            if len(batch) >= batch_size:
+                _flush_copies(staging_collection, batch)
+                copied += len(batch)
+                batch = []
+                if streamed % (batch_size * 10) == 0:
+                    logger.info("Streamed %d documents (%.0f docs/s).", streamed, streamed / (time.time() - started))
+    _flush_copies(staging_collection, batch)
+    return copied + len(batch)
+
+def _stream_chunks(chunk_collection, builds, route, batch_size, started, reducer=None):
+    """Add one item per embedded chunk; the id map points each item at the chunk's parent."""
+    streamed = 0
+    cursor = chunk_collection.find(
+        {"embedding": {"$exists": True}}, {"parent_id": 1, "embedding": 1},
+        batch_size=batch_size, no_cursor_timeout=True
+    ).sort("_id", 1)
+    with cursor:
+        for chunk in cursor:
+            emb = chunk.get("embedding")
+            if emb is None:
+                continue
+            build = builds[route(chunk)]
+            if build is None:
+                continue
+            build.add(_reduced(emb, reducer), chunk["parent_id"])
+            streamed += 1
+            if streamed % (batch_size * 10) == 0:
+                logger.info("Streamed %d chunks (%.0f chunks/s).", streamed, streamed / (time.time() - started))
+
+def _copy_parents(source, staging_collection, batch_size, projection=None, keep=None):
+    """
+    Copy the parent documents of a chunked collection into the staging collection.
+
+    :param keep: Optional predicate selecting the documents to copy.
+    :return: Number of documents copied.
+    """
+    count = 0
+    batch = []
+    cursor = source.find({}, projection or {"embedding": 0}, batch_size=batch_size, no_cursor_timeout=True)
+    with cursor:
+        for doc in cursor:
+            if keep is not None and not keep(doc):
+                continue
+            doc.pop("embedding", None)
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                _flush_copies(staging_collection, batch)
+                count += len(batch)
+                batch = []
+    _flush_copies(staging_collection, batch)
+    return count + len(batch)
+
+def _document_router(config, shard_count):
+    """Shard of an embedded document, from its "shard_key" field (default "_id")."""
+    shard_key = config.get("shard_key", "_id")
+    if shard_count == 1:
+        return lambda doc: 0
+    return lambda doc: shard_of(doc.get(shard_key), shard_count)
+
+def _chunk_router(config, shard_count, parents):
+    """
+    Shard of a chunk: the shard of its parent document. Sharding by a parent field
+    (e.g. jurisdiction) needs the parents' values, which are loaded once up front.
+    """
+    shard_key = config.get("shard_key", "_id")
+    if shard_count == 1:
+        return lambda chunk: 0
+    if shard_key == "_id":
+        return lambda chunk: shard_of(chunk["parent_id"], shard_count)
+    parent_shards = {doc["_id"]: shard_of(doc.get(shard_key), shard_count)
+                     for doc in parents.find({}, {shard_key: 1})}
+    return lambda chunk: parent_shards.get(chunk["parent_id"], shard_of(None, shard_count))
+
+def prebuild_annoy_index(config, batch_size=BUILD_BATCH_SIZE, projection=None,
+                         n_trees=None, n_jobs=ANNOY_BUILD_JOBS, on_disk=ANNOY_ON_DISK_BUILD, shards=None):
+    """
+    Build the Annoy index, id map and annoy collection for a configuration
+    by streaming the embedding collection in batches, so memory stays bounded
+    by the Annoy index itself plus one batch of documents.
+    For configurations with a "chunk_collection_name" the index holds one item
+    per chunk and the id map points every chunk at its parent document.
+    Vectors are indexed at the configuration's "dimensions"; with "reduction": "pca"
+    the projection is fitted first and stored next to the index.
+
+    :param config: One of the dictionaries in config.COLLECTION.
+    :param batch_size: Cursor batch size and number of documents per bulk insert.
+    :param projection: Optional projection for the embedding collection cursor
+        (must keep "embedding" and the shard key); by default every field is copied.
+    :param n_trees: Number of trees; defaults to the collection's "annoy_tree_count" or ANNOY_TREE_COUNT.
+    :param n_jobs: Threads used to build the trees (-1 for all cores).
+    :param on_disk: Build the index directly in its file instead of in RAM.
+    :param shards: For sharded configurations, the shard numbers to rebuild (default: all).
+        The other shards, and their documents in the annoy collection, are left as they are.
+
+    Collections with "backend": "exact" get a float32 vector file (see search_backends)
+    instead of Annoy trees; "ivfpq" collections get the vector file plus an IVF-PQ model
+    and codes trained on it (see ivfpq). n_trees, n_jobs and on_disk only apply to Annoy.
+    A full build also records the newest indexed document in a manifest and drops the
+    delta index, whose documents it now contains (see preprocess.update_delta_index).
+    Configurations with "shards": N are split into N indexes by a hash of their "shard_key"
+    field (default "_id", e.g. "jurisdiction" to keep a jurisdiction together), which are
+    built in parallel, one core each.
+
+    The index and id map are written to temporary files and renamed into place,
+    so a running AnnoySearch never sees a half-written index.
+    """
+    if n_trees is None:
+        n_trees = config.get("annoy_tree_count", ANNOY_TREE_COUNT)
+    backend = config.get("backend", "annoy")
+    paths = shard_paths(config)
+    selected = sorted(set(shards)) if shards is not None else list(range(len(paths)))
+    if not selected or selected[0] < 0 or selected[-1] >= len(paths):
+        raise ValueError(f"Shards must be between 0 and {len(paths) - 1}, got {shards}.")
+    partial = len(selected) < len(paths)
+    for number in selected:
+        logger.info("INDEX_PATH (%s): %s", backend, paths[number][0])
+        logger.info("ID_MAP_PATH: %s", paths[number][1])
+    if backend == "annoy":
+        logger.info("Trees: %d | build jobs: %d | on-disk build: %s", n_trees, n_jobs, on_disk)
+    PCA_PATH = pca_path(config)
+    tmp_pca_path = PCA_PATH + ".tmp"
+    started = time.time()
     
     client = MongoClient(MONGO_URI)
     db = client[config["db_name"]]
     
     # Use the embedding collection for reading the documents.
     embedding_collection = db[config["embedding_collection_name"]]
-    # Use the annoy collection for storing the copied documents.
-    annoy_collection = db[config["annoy_collection_name"]]
+    # Copies are written to a staging collection and renamed over the annoy collection
+    # at the end, so searches keep working against the previous copy during the build.
+    annoy_collection_name = config["annoy_collection_name"]
+    staging_collection = db[annoy_collection_name + "_staging"]
+    staging_collection.drop()
     
-    # Fetch all documents that have embeddings.
-    docs = list(embedding_collection.find({"embedding": {"$exists": True}}))
-    logger.info("Fetched %d documents with embeddings from '%s'.", len(docs), config["embedding_collection_name"])
-    
-    # Create Annoy index and build an id mapping.
-    index = AnnoyIndex(VECTOR_SIZE, 'angular')
-    id_map = {}
-    copied_docs = []  # List to hold documents to be inserted into annoy_collection.
-    
-    for i, doc in enumerate(docs):
-        emb = doc.get("embedding")
-        if emb is not None:
-            index.add_item(i, emb)
-            id_map[i] = str(doc["_id"])  # Store original ObjectId as string.
-            # Create a new document without the embedding field.
-            new_doc = {k: v for k, v in doc.items() if k != "embedding"}
-            # Add the "map_id" field.
-            new_doc["map_id"] = str(i)
-            copied_docs.append(new_doc)
-    
-    # Ensure the directory for the Annoy index exists.
-    index_dir = os.path.dirname(ANNOY_INDEX_PATH)
+    # Ensure the directory for the index exists.
+    index_dir = os.path.dirname(paths[0][0])
     if not os.path.exists(index_dir):
         os.makedirs(index_dir)
-        logger.info("Created directory for Annoy index: %s", index_dir)
+        logger.info("Created directory for the index: %s", index_dir)
     
-    # Build and save the Annoy index.
-    index.build(ANNOY_TREE_COUNT)
-    index.save(ANNOY_INDEX_PATH)
-    logger.info("Annoy index built and saved to %s", ANNOY_INDEX_PATH)
+    chunk_collection_name = config.get("chunk_collection_name")
+    vector_source = db[chunk_collection_name] if chunk_collection_name else embedding_collection
+    if partial and config.get("reduction") == "pca" and os.path.exists(PCA_PATH):
+        # Every shard must share one projection: reuse it when rebuilding only some shards.
+        reducer = PCAReducer.load(PCA_PATH)
+    else:
+        reducer = _fit_reducer(config, vector_source, tmp_pca_path)
+    vector_size = reducer.dimensions if reducer is not None else VECTOR_SIZE
+    logger.info("Indexing %d-dimensional vectors (%s).", vector_size, reducer.kind if reducer is not None else "full size")
     
-    # Save the id mapping to file (as fallback).
-    with open(ID_MAP_PATH, "wb") as f:
-        pickle.dump(id_map, f)
-    logger.info("ID map saved to file: %s", ID_MAP_PATH)
+    # Create the index and the binary id map (row i holds the ObjectId of item i) of every shard rebuilt.
+    builds = [None] * len(paths)
+    for number in selected:
+        builds[number] = _ShardBuild(number, paths[number][0], paths[number][1], vector_size, backend, on_disk,
+                                     vectors_path=vectors_path(config), ivf_lists=config.get("ivf_lists"),
+                                     pq_subvectors=config.get("pq_subvectors", PQ_SUBVECTORS))
+    active = [build for build in builds if build is not None]
     
-    # For the annoy collection, clear previous data to avoid duplicates.
-    annoy_collection.delete_many({})
-    logger.info("Cleared previous documents from collection '%s'.", config["annoy_collection_name"])
+    # Newest document the build can see; the delta index (preprocess.update_delta_index)
+    # picks up everything embedded after it.
+    newest = vector_source.find_one({"embedding": {"$exists": True}}, {"_id": 1}, sort=[("_id", -1)])
     
-    # Insert the copied documents into the annoy collection.
-    if copied_docs:
-        result = annoy_collection.insert_many(copied_docs, ordered=False)
-        logger.info("Inserted %d documents into '%s'.", len(result.inserted_ids), config["annoy_collection_name"])
+    try:
+        route = _document_router(config, len(paths))
+        if chunk_collection_name:
+            # Chunked collection: one item per chunk, mapped to its parent document,
+            # and the parents themselves are copied into the annoy collection.
+            _stream_chunks(vector_source, builds, _chunk_router(config, len(paths), embedding_collection),
+                           batch_size, started, reducer)
+            keep = (lambda doc: builds[route(doc)] is not None) if partial else None
+            copied_count = _copy_parents(embedding_collection, staging_collection, batch_size, projection, keep)
+        else:
+            copied_count = _stream_documents(embedding_collection, staging_collection, builds, route,
+                                             batch_size, projection, started, reducer)
+        item_count = sum(build.count for build in active)
+        load_seconds = time.time() - started
+        logger.info("Streamed %d vectors from '%s' in %.1fs.",
+                    item_count, chunk_collection_name or config["embedding_collection_name"], load_seconds)
+        if item_count == 0:
+            # Swapping an empty index in would leave every search without results.
+            raise ValueError("No embedded %s in '%s'; keeping the current index." % (
+                "chunks" if chunk_collection_name else "documents",
+                chunk_collection_name or config["embedding_collection_name"]))
+        
+        # Build and save the index; shards are built in parallel with one core each.
+        build_started = time.time()
+        if len(active) == 1:
+            active[0].build(n_trees, n_jobs)
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(active), os.cpu_count() or 1)) as pool:
+                list(pool.map(lambda build: build.build(n_trees, 1), active))
+    except Exception:
+        for build in active:
+            build.discard()
+        _remove_quietly(tmp_pca_path)
+        staging_collection.drop()
+        client.close()
+        raise
+    build_seconds = time.time() - build_started
+    
+    if os.path.exists(tmp_pca_path):
+        os.replace(tmp_pca_path, PCA_PATH)
+        logger.info("PCA projection saved to file: %s", PCA_PATH)
+    for build in active:
+        build.commit()
+    if not partial:
+        # The new index holds everything up to `newest`, which makes the delta redundant.
+        _write_manifest(config, newest["_id"] if newest else None)
+        _remove_delta(config)
+    
+    # Swap the staged copies in as the annoy collection.
+    if copied_count and partial:
+        # Only some shards were rebuilt: upsert their documents into the live collection.
+        staging_collection.aggregate([{"$merge": {"into": annoy_collection_name, "on": "_id",
+                                                  "whenMatched": "replace", "whenNotMatched": "insert"}}])
+        staging_collection.drop()
+        logger.info("Merged %d copied documents of shard(s) %s into '%s'.", copied_count, selected, annoy_collection_name)
+    elif copied_count:
+        staging_collection.rename(annoy_collection_name, dropTarget=True)
+        logger.info("Replaced '%s' with %d copied documents.", annoy_collection_name, copied_count)
     else:
-        logger.warning("No documents to copy into '%s'.", config["annoy_collection_name"])
+        staging_collection.drop()
+        logger.warning("No documents to copy into '%s'.", annoy_collection_name)
     
     client.close()
     logger.info("MongoDB connection closed.")
+    
+    total_seconds = time.time() - started
+    peak_mb = _peak_memory_mb()
+    logger.info("Build summary: %d items | stream %.1fs (%.0f docs/s) | build %.1fs | total %.1fs | peak memory %s",
+                item_count, load_seconds, item_count / load_seconds if load_seconds else 0.0,
+                build_seconds, total_seconds, "%.0f MB" % peak_mb if peak_mb is not None else "n/a")
 
 if __name__ == "__main__":
     # List available configurations.
@@ -99,4 +461,14 @@ if __name__ == "__main__":
     logger.info("Using configuration: %s", config["document_type"])
     logger.info("Selected configuration details: %s", json.dumps(config, indent=4))
     
-    prebuild_annoy_index(config)
+    shards = None
+    shard_count = config.get("shards", 1)
+    if shard_count > 1:
+        answer = input(f"Shards to rebuild (0-{shard_count - 1}, comma separated; blank for all): ").strip()
+        if answer:
+            try:
+                shards = [int(part) for part in answer.split(",")]
+            except ValueError:
+                logger.warning("Invalid shard list provided. Rebuilding all shards.")
+    
+    prebuild_annoy_index(config, shards=shards)
@@ -0,0 +1,111 @@
+import json
+import time
+import logging
+import argparse
+from pymongo import MongoClient
+from config import MONGO_URI, EMBEDDING_MODEL, COLLECTION, CHUNK_TOKENS, CHUNK_OVERLAP
+from preprocess.job_store import JobCheckpoint
+from tokenizer import get_encoding
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+PARENTS_PER_CHECKPOINT = 200  # Parent documents chunked between checkpoints
+
+def token_windows(token_count, size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    """
+    Return (start, end) token offsets of overlapping windows covering token_count tokens.
+    Consecutive windows share `overlap` tokens so no passage is cut without context.
+    """
+    if size <= overlap:
+        raise ValueError("Chunk size must be larger than the overlap.")
+    windows = []
+    start = 0
+    while True:
+        end = min(start + size, token_count)
+        windows.append((start, end))
+        if end >= token_count:
+            return windows
+        start += size - overlap
+
+def chunk_document(doc, encoding, size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    """
+    Split a parent document's text into chunk documents ready for insertion.
+
+    :return: A list of dicts with parent_id, chunk_index, token offsets and text.
+    """
+    text = (doc.get("text") or "").strip()
+    if not text:
+        return []
+    tokens = encoding.encode(text, disallowed_special=())
+    return [
+        {
+            "parent_id": doc["_id"],
+            "chunk_index": i,
+            "token_start": start,
+            "token_end": end,
+            "text": encoding.decode(tokens[start:end]),
+        }
+        for i, (start, end) in enumerate(token_windows(len(tokens), size, overlap))
+    ]
+
+def run_chunking_job(config, restart=False):
+    """
+    Split every document of the embedding collection into overlapping token windows
+    stored in the configuration's chunk collection, ready for preprocess.update_embedding --chunks.
+    Resumable: progress is checkpointed after every PARENTS_PER_CHECKPOINT parents,
+    and re-chunking a parent replaces its previous chunks.
+    """
+    chunk_collection_name = config.get("chunk_collection_name")
+    if not chunk_collection_name:
+        logger.error("Configuration '%s' has no chunk_collection_name; nothing to do.", config["document_type"])
+        return
+    size = config.get("chunk_tokens", CHUNK_TOKENS)
+    overlap = config.get("chunk_overlap", CHUNK_OVERLAP)
+    encoding = get_encoding(EMBEDDING_MODEL)
+
+    with MongoClient(MONGO_URI) as client:
+        db = client[config["db_name"]]
+        parents = db[config["embedding_collection_name"]]
+        chunks = db[chunk_collection_name]
+        chunks.create_index([("parent_id", 1), ("chunk_index", 1)], unique=True)
+        job = JobCheckpoint(db, "chunking:" + chunk_collection_name)
+        if restart:
+            job.reset()
+        last_id = job.load().get("last_id")
+        logger.info("Chunking '%s' into '%s' (%d tokens, %d overlap), resuming after _id %s.",
+                    config["embedding_collection_name"], chunk_collection_name, size, overlap, last_id)
+
+        started = time.time()
+        parent_count = chunk_count = 0
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+            batch = list(parents.find(query, {"text": 1}).sort("_id", 1).limit(PARENTS_PER_CHECKPOINT))
+            if not batch:
+                break
+            new_chunks = []
+            for doc in batch:
+                new_chunks.extend(chunk_document(doc, encoding, size, overlap))
+            chunks.delete_many({"parent_id": {"$in": [doc["_id"] for doc in batch]}})
+            if new_chunks:
+                chunks.insert_many(new_chunks, ordered=False)
+            last_id = batch[-1]["_id"]
+            parent_count += len(batch)
+            chunk_count += len(new_chunks)
+            job.advance(last_id, processed=len(batch))
+            logger.info("Chunked %d documents into %d chunks (%.1f docs/s).",
+                        parent_count, chunk_count, parent_count / max(time.time() - started, 1e-9))
+        job.set_status("completed")
+        logger.info("Chunking complete: %d documents, %d chunks.", parent_count, chunk_count)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split documents into overlapping token chunks.")
+    parser.add_argument("--collection", choices=list(COLLECTION), default=list(COLLECTION)[0])
+    parser.add_argument("--restart", action="store_true", help="re-chunk every document")
+    args = parser.parse_args()
+
+    config = COLLECTION[args.collection]
+    logger.info("Using configuration: %s", config["document_type"])
+    logger.info("Selected configuration details: %s", json.dumps(config, indent=4))
+    run_chunking_job(config, args.restart)
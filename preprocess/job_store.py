@@ -0,0 +1,159 @@
+import time
+import random
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pymongo import UpdateOne, ReturnDocument
+import openai
+from config import JOB_COLLECTION_NAME, DEAD_LETTER_COLLECTION_NAME
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+MAX_RETRIES = 6  # Retries per request on rate limits and transient errors
+WRITE_BATCH_SIZE = 500  # UpdateOne operations per bulk_write
+
+# Errors worth retrying with backoff; anything else fails the request immediately.
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+class JobCheckpoint:
+    """
+    Persistent progress of a preprocessing job, stored in MongoDB so the job can
+    be stopped or crash at any point and resume where it left off.
+
+    The checkpoint document holds the last processed _id and running counters;
+    documents that failed are kept in a dead-letter collection for a later retry.
+    """
+
+    def __init__(self, db, job_name):
+        """
+        :param db: MongoDB database instance.
+        :param job_name: Unique name of the job, e.g. "embedding:us_constitution_embedding".
+        """
+        self.job_name = job_name
+        self.jobs = db[JOB_COLLECTION_NAME]
+        self.dead_letters = db[DEAD_LETTER_COLLECTION_NAME]
+        self.dead_letters.create_index([("job", 1), ("doc_id", 1)], unique=True)
+
+    def load(self):
+        """Return the checkpoint document, creating an empty one for a new job."""
+        now = datetime.datetime.now()
+        return self.jobs.find_one_and_update(
+            {"_id": self.job_name},
+            {"$setOnInsert": {"last_id": None, "processed": 0, "failed": 0,
+                              "status": "new", "created_at": now}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    def reset(self):
+        """Forget all progress and dead letters of the job."""
+        self.jobs.delete_one({"_id": self.job_name})
+        self.dead_letters.delete_many({"job": self.job_name})
+        logger.info("Reset checkpoint of job '%s'.", self.job_name)
+
+    def advance(self, last_id, processed=0, failed=0, **fields):
+        """Record that everything up to last_id has been handled and bump the counters."""
+        fields.update({"last_id": last_id, "status": "running", "updated_at": datetime.datetime.now()})
+        self.jobs.update_one({"_id": self.job_name},
+                             {"$set": fields, "$inc": {"processed": processed, "failed": failed}})
+
+    def set_status(self, status, **fields):
+        fields.update({"status": status, "updated_at": datetime.datetime.now()})
+        self.jobs.update_one({"_id": self.job_name}, {"$set": fields})
+
+    def add_dead_letters(self, failures):
+        """Store (doc_id, error) pairs for documents that could not be processed."""
+        if not failures:
+            return
+        now = datetime.datetime.now()
+        self.dead_letters.bulk_write([
+            UpdateOne({"job": self.job_name, "doc_id": doc_id},
+                      {"$set": {"error": str(error), "failed_at": now}, "$inc": {"attempts": 1}},
+                      upsert=True)
+            for doc_id, error in failures
+        ], ordered=False)
+        logger.warning("Added %d documents to the dead-letter list of '%s'.", len(failures), self.job_name)
+
+    def dead_letter_ids(self):
+        return [doc["doc_id"] for doc in self.dead_letters.find({"job": self.job_name}, {"doc_id": 1})]
+
+    def clear_dead_letters(self, doc_ids):
+        if doc_ids:
+            self.dead_letters.delete_many({"job": self.job_name, "doc_id": {"$in": list(doc_ids)}})
+
+
+def _retry_after(error):
+    """Seconds the server asked us to wait, if it said so."""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def call_with_backoff(func, *args, max_retries=MAX_RETRIES, description="Request", **kwargs):
+    """Call func(*args, **kwargs), retrying rate limits and transient errors with exponential backoff and jitter."""
+    delay = 1.0
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            wait_seconds = _retry_after(e) or delay * (1 + random.random())
+            logger.warning("%s failed (%s); retrying in %.1fs (attempt %d/%d).",
+                           description, type(e).__name__, wait_seconds, attempt + 1, max_retries)
+            time.sleep(wait_seconds)
+            delay = min(delay * 2, 60)
+
+def run_pipelined(items, call, handle, collections, concurrency, write_batch_size=WRITE_BATCH_SIZE):
+    """
+    Run call(item) for every item on a thread pool with at most `concurrency` calls in
+    flight, and write what the results produce back with bulk_write.
+
+    :param items: Iterable of work items, consumed lazily.
+    :param call: Function run on the pool for each item.
+    :param handle: handle(item, result, error), run in the calling thread as calls finish
+        (error is the exception raised by call, or None); returns the UpdateOne operations to write.
+    :param collections: Collections every operation is written to.
+    :param concurrency: Calls kept in flight.
+    """
+    writes = []
+    in_flight = {}  # future -> item
+
+    def flush():
+        if writes:
+            for collection in collections:
+                collection.bulk_write(writes, ordered=False)
+            writes.clear()
+
+    def collect(futures):
+        for future in futures:
+            item = in_flight.pop(future)
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = None, e
+            writes.extend(handle(item, result, error))
+            if len(writes) >= write_batch_size:
+                flush()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for item in items:
+            if len(in_flight) >= concurrency:
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[pool.submit(call, item)] = item
+        collect(list(in_flight))
+    flush()
+
+def format_eta(seconds):
+    if seconds is None:
+        return "unknown"
+    return str(datetime.timedelta(seconds=int(seconds)))
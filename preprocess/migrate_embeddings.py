@@ -0,0 +1,109 @@
+import json
+import time
+import logging
+import argparse
+from pymongo import MongoClient, UpdateOne
+from config import MONGO_URI, COLLECTION, EMBEDDING_STORAGE_FORMAT
+from embedding_codec import encode_embedding, decode_embedding, storage_format_of, STORAGE_FORMATS
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+MIGRATE_BATCH_SIZE = 500  # UpdateOne operations per bulk_write
+SAMPLE_DOCS = 2000  # Documents read back to measure decode throughput before and after
+
+def _collection_stats(db, name):
+    """Data size, average document size and on-disk storage size of a collection, in bytes."""
+    stats = db.command("collStats", name)
+    return {"count": stats.get("count", 0), "size": stats.get("size", 0),
+            "avg_obj_size": stats.get("avgObjSize", 0), "storage_size": stats.get("storageSize", 0)}
+
+def _read_throughput(collection, sample=SAMPLE_DOCS):
+    """Embeddings read and decoded into numpy per second over the first `sample` documents."""
+    started = time.perf_counter()
+    count = 0
+    for doc in collection.find({"embedding": {"$exists": True}}, {"embedding": 1}).sort("_id", 1).limit(sample):
+        decode_embedding(doc["embedding"])
+        count += 1
+    seconds = time.perf_counter() - started
+    return count / seconds if seconds else 0.0
+
+def migrate_embeddings(db, collection_name, storage_format=EMBEDDING_STORAGE_FORMAT,
+                       batch_size=MIGRATE_BATCH_SIZE, compact=False):
+    """
+    Rewrite every embedding of a collection in `storage_format`, skipping those already
+    stored that way (so an interrupted migration can simply be run again), and log a
+    before/after comparison of collection size and read throughput.
+
+    :param compact: Run MongoDB's compact afterwards so the freed space is returned;
+        without it storageSize only shrinks as WiredTiger reuses the pages.
+    :return: Dict with the before/after statistics and the number of documents converted.
+    """
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError("Unknown embedding storage format: %r" % (storage_format,))
+    collection = db[collection_name]
+    before = _collection_stats(db, collection_name)
+    before["read_per_second"] = _read_throughput(collection)
+
+    started = time.time()
+    converted = skipped = 0
+    writes = []
+    cursor = collection.find({"embedding": {"$exists": True}}, {"embedding": 1},
+                             batch_size=batch_size, no_cursor_timeout=True).sort("_id", 1)
+    with cursor:
+        for doc in cursor:
+            if storage_format_of(doc["embedding"]) == storage_format:
+                skipped += 1
+                continue
+            vector = decode_embedding(doc["embedding"])
+            writes.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"embedding": encode_embedding(vector, storage_format)}}))
+            if len(writes) >= batch_size:
+                collection.bulk_write(writes, ordered=False)
+                converted += len(writes)
+                writes = []
+                logger.info("Converted %d embeddings (%.0f docs/s).", converted, converted / (time.time() - started))
+    if writes:
+        collection.bulk_write(writes, ordered=False)
+        converted += len(writes)
+    seconds = time.time() - started
+    logger.info("Converted %d embeddings to %s in %.1fs (%d already converted).",
+                converted, storage_format, seconds, skipped)
+
+    if compact:
+        logger.info("Compacting '%s'...", collection_name)
+        db.command("compact", collection_name)
+    after = _collection_stats(db, collection_name)
+    after["read_per_second"] = _read_throughput(collection)
+
+    mb = 1024 * 1024
+    logger.info("%-16s %12s %12s", "", "before", "after")
+    logger.info("%-16s %12.1f %12.1f", "data size MB", before["size"] / mb, after["size"] / mb)
+    logger.info("%-16s %12.1f %12.1f", "avg doc KB", before["avg_obj_size"] / 1024, after["avg_obj_size"] / 1024)
+    logger.info("%-16s %12.1f %12.1f", "storage MB", before["storage_size"] / mb, after["storage_size"] / mb)
+    logger.info("%-16s %12.0f %12.0f", "read docs/s", before["read_per_second"], after["read_per_second"])
+    return {"converted": converted, "skipped": skipped, "seconds": seconds, "before": before, "after": after}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert stored embeddings to another storage format.")
+    parser.add_argument("--collection", choices=list(COLLECTION), default=list(COLLECTION)[0])
+    parser.add_argument("--format", choices=STORAGE_FORMATS, default=EMBEDDING_STORAGE_FORMAT)
+    parser.add_argument("--chunks", action="store_true", help="migrate the chunk collection instead of the documents")
+    parser.add_argument("--queries", action="store_true", help="migrate the stored query embeddings instead of the documents")
+    parser.add_argument("--compact", action="store_true", help="compact the collection afterwards to release disk space")
+    args = parser.parse_args()
+
+    config = COLLECTION[args.collection]
+    logger.info("Using configuration: %s", config["document_type"])
+    logger.info("Selected configuration details: %s", json.dumps(config, indent=4))
+    if args.queries:
+        collection_name = config["query_collection_name"]
+    elif args.chunks:
+        collection_name = config.get("chunk_collection_name")
+        if not collection_name:
+            parser.error(f"Configuration '{config['document_type']}' has no chunk_collection_name.")
+    else:
+        collection_name = config["embedding_collection_name"]
+
+    with MongoClient(MONGO_URI) as client:
+        migrate_embeddings(client[config["db_name"]], collection_name, args.format, compact=args.compact)
@@ -0,0 +1,50 @@
+import os
+import json
+import logging
+from config import COLLECTION
+from id_map import convert_pickle_id_map
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+def migrate_id_map(config):
+    """
+    Convert the pickled id map of a collection into the binary id map read by AnnoySearch.
+    The pickle is left in place so older deployments can still read it.
+    """
+    legacy_path = config.get("legacy_id_map_path")
+    id_map_path = config["id_map_path"]
+    if not legacy_path or not os.path.exists(legacy_path):
+        logger.warning("No legacy ID map to migrate for '%s'.", config["document_type"])
+        return
+    if os.path.exists(id_map_path):
+        logger.info("Binary ID map already exists at %s; overwriting.", id_map_path)
+    # Write next to the target and rename, so a running search never sees a partial file.
+    tmp_path = id_map_path + ".tmp"
+    count = convert_pickle_id_map(legacy_path, tmp_path)
+    os.replace(tmp_path, id_map_path)
+    logger.info("Wrote %d ids to %s (%d bytes, was %d bytes).",
+                count, id_map_path, os.path.getsize(id_map_path), os.path.getsize(legacy_path))
+
+if __name__ == "__main__":
+    # List available configurations.
+    keys = list(COLLECTION.keys())
+    logger.info("Available configurations:")
+    for i, key in enumerate(keys, start=1):
+        doc_type = COLLECTION[key].get("document_type", "Unknown")
+        logger.info("%d: %s", i, doc_type)
+
+    try:
+        selected_num = int(input("Enter configuration number: ").strip())
+        if selected_num < 1 or selected_num > len(keys):
+            raise ValueError("Selection out of range")
+    except Exception as e:
+        logger.warning("Invalid configuration number provided. Defaulting to 1.")
+        selected_num = 1
+
+    config = COLLECTION[keys[selected_num - 1]]
+    logger.info("Using configuration: %s", config["document_type"])
+    logger.info("Selected configuration details: %s", json.dumps(config, indent=4))
+
+    migrate_id_map(config)
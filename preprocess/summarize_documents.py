@@ -0,0 +1,161 @@
+import json
+import time
+import logging
+import argparse
+from pymongo import MongoClient, UpdateOne
+from config import MONGO_URI, COLLECTION, QUERY_COLLECTION_NAME
+from openai_service import ChatGPT
+from preprocess.job_store import JobCheckpoint, call_with_backoff, run_pipelined, format_eta
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+SUMMARY_CONCURRENCY = 8  # Chat completions kept in flight
+SUMMARY_MAX_RETRIES = 6  # Retries per document on rate limits and transient errors
+SUMMARY_CHUNK_SIZE = 200  # Documents summarised between checkpoints
+
+# Documents that still need a summary ("" marks an earlier failed attempt).
+MISSING_SUMMARY = {"$or": [{"summary": {"$exists": False}}, {"summary": ""}, {"summary": None}]}
+
+def result_frequencies(query_collection, annoy_collection_name):
+    """
+    How often each document was returned by user queries, most frequent first,
+    from the "results" recorded by DatabaseHandler.process_query.
+
+    :return: A list of (ObjectId, count) tuples.
+    """
+    field = f"results.{annoy_collection_name}"
+    pipeline = [
+        {"$match": {field: {"$exists": True}}},
+        {"$unwind": "$" + field},
+        {"$group": {"_id": "$" + field, "count": {"$sum": {"$ifNull": ["$searches", 1]}}}},
+        {"$sort": {"count": -1}},
+    ]
+    return [(doc["_id"], doc["count"]) for doc in query_collection.aggregate(pipeline, allowDiskUse=True)]
+
+def summarize_batch(collections, docs, service, concurrency=SUMMARY_CONCURRENCY):
+    """
+    Summarise documents with up to `concurrency` chat completions in flight and write
+    the summaries back with bulk_write of UpdateOne operations keyed by _id.
+
+    :param collections: Collections receiving the "summary" field: the annoy collection
+        served to users and the embedding collection it is rebuilt from.
+    :param docs: Documents with "_id" and "text".
+    :return: Dict with "summarized", "failed" and "failures" ((_id, error) pairs).
+    """
+    stats = {"summarized": 0, "failed": 0, "failures": []}
+
+    def summarize(item):
+        return call_with_backoff(service.generate_summary, item[1], max_retries=SUMMARY_MAX_RETRIES,
+                                 description="Summary request")
+
+    def handle(item, summary, error):
+        doc_id = item[0]
+        if error is not None:
+            stats["failed"] += 1
+            stats["failures"].append((doc_id, error))
+            logger.error("Error summarising document %s: %s", doc_id, error)
+            return []
+        stats["summarized"] += 1
+        return [UpdateOne({"_id": doc_id}, {"$set": {"summary": summary}})]
+
+    texts = ((doc["_id"], (doc.get("text") or "").strip()) for doc in docs)
+    run_pipelined(((doc_id, text) for doc_id, text in texts if text), summarize, handle, collections, concurrency)
+    return stats
+
+def run_summary_job(config, restart=False, include_unseen=False, limit=None,
+                    chunk_size=SUMMARY_CHUNK_SIZE, concurrency=SUMMARY_CONCURRENCY):
+    """
+    Fill the "summary" field of a collection's annoy documents ahead of time, so /result
+    almost always finds a stored summary instead of waiting for a completion.
+
+    Documents are summarised in order of how often they appeared in query results
+    (User_queries), then, with include_unseen, every other document in _id order. Only
+    documents without a summary are sent, so a stopped job simply continues where it
+    was; the checkpoint keeps the counters and the position of the _id-ordered pass,
+    and documents that failed go to the job's dead-letter list.
+
+    :param restart: Discard the checkpoint (existing summaries are kept).
+    :param include_unseen: Also summarise documents that no query has returned yet.
+    :param limit: Stop after this many documents.
+    :param chunk_size: Documents summarised between checkpoints.
+    :param concurrency: Chat completions kept in flight.
+    """
+    annoy_collection_name = config["annoy_collection_name"]
+    with MongoClient(MONGO_URI) as client:
+        db = client[config["db_name"]]
+        annoy_collection = db[annoy_collection_name]
+        targets = [annoy_collection, db[config["embedding_collection_name"]]]
+        job = JobCheckpoint(db, "summary:" + annoy_collection_name)
+        if restart:
+            job.reset()
+        state = job.load()
+        service = ChatGPT(db, annoy_collection_name, config.get("unique_index", "title"), preprocess=True)
+        started = time.time()
+        done = 0
+
+        def run_chunk(query):
+            nonlocal done
+            chunk = list(annoy_collection.find(query, {"text": 1}).sort("_id", 1))
+            stats = summarize_batch(targets, chunk, service, concurrency)
+            job.add_dead_letters(stats["failures"])
+            done += len(chunk)
+            rate = done / max(time.time() - started, 1e-9)
+            return chunk, stats, rate
+
+        # 1. Documents users have actually been shown, most frequent first.
+        ranked = [doc_id for doc_id, _ in result_frequencies(db[config.get("query_collection_name", QUERY_COLLECTION_NAME)],
+                                                              annoy_collection_name)]
+        if limit is not None:
+            ranked = ranked[:limit]
+        logger.info("Job '%s': %d documents appear in query results.", job.job_name, len(ranked))
+        for start in range(0, len(ranked), chunk_size):
+            ids = ranked[start:start + chunk_size]
+            chunk, stats, rate = run_chunk({"_id": {"$in": ids}, **MISSING_SUMMARY})
+            job.advance(state.get("last_id"), processed=stats["summarized"], failed=stats["failed"], docs_per_second=rate)
+            logger.info("Ranked documents %d-%d of %d: %d summarised, %d already had one (%.1f docs/s).",
+                        start + 1, start + len(ids), len(ranked), stats["summarized"], len(ids) - len(chunk), rate)
+
+        # 2. Everything else, in _id order from the checkpoint.
+        if include_unseen and (limit is None or done < limit):
+            last_id = state.get("last_id")
+            remaining = annoy_collection.count_documents(
+                {**MISSING_SUMMARY, **({"_id": {"$gt": last_id}} if last_id is not None else {})})
+            logger.info("Job '%s': resuming after _id %s; %d unseen documents to go.", job.job_name, last_id, remaining)
+            unseen_done = 0
+            while limit is None or done < limit:
+                size = chunk_size if limit is None else min(chunk_size, limit - done)
+                query = dict(MISSING_SUMMARY)
+                if last_id is not None:
+                    query["_id"] = {"$gt": last_id}
+                ids = [doc["_id"] for doc in annoy_collection.find(query, {"_id": 1}).sort("_id", 1).limit(size)]
+                if not ids:
+                    break
+                chunk, stats, rate = run_chunk({"_id": {"$in": ids}})
+                last_id = ids[-1]
+                unseen_done += len(ids)
+                eta = (remaining - unseen_done) / rate if rate else None
+                job.advance(last_id, processed=stats["summarized"], failed=stats["failed"],
+                            docs_per_second=rate, eta_seconds=eta)
+                logger.info("Checkpoint at _id %s: %d/%d unseen documents (%.1f docs/s), ETA %s",
+                            last_id, unseen_done, remaining, rate, format_eta(eta))
+
+        job.set_status("completed")
+        logger.info("Job '%s' completed: %d documents in %.1fs.", job.job_name, done, time.time() - started)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate document summaries in bulk, most-viewed documents first.")
+    parser.add_argument("--collection", choices=list(COLLECTION), default=list(COLLECTION)[0])
+    parser.add_argument("--restart", action="store_true", help="discard the checkpoint and start from the beginning")
+    parser.add_argument("--all", action="store_true", help="also summarise documents no query has returned yet")
+    parser.add_argument("--limit", type=int, help="stop after this many documents")
+    parser.add_argument("--chunk-size", type=int, default=SUMMARY_CHUNK_SIZE, help="documents per checkpoint")
+    parser.add_argument("--concurrency", type=int, default=SUMMARY_CONCURRENCY)
+    args = parser.parse_args()
+
+    config = COLLECTION[args.collection]
+    logger.info("Using configuration: %s", config["document_type"])
+    logger.info("Selected configuration details: %s", json.dumps(config, indent=4))
+
+    run_summary_job(config, args.restart, args.all, args.limit, args.chunk_size, args.concurrency)
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from pymongo import MongoClient, ReplaceOne
+from config import MONGO_URI, EMBEDDING_DIMENSIONS, COLLECTION, DELTA_COMPACT_ITEMS, DELTA_UPDATE_INTERVAL
+from id_map import IdMapWriter
+from dimension_reduction import get_reducer
+from search_backends import VectorFileWriter, delta_paths
+from preprocess.build_searchEngine import prebuild_annoy_index, read_manifest, _reduced, _remove_quietly, BUILD_BATCH_SIZE
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+def _upsert_copies(collection, docs):
+    """Insert or replace copies of documents in the annoy collection."""
+    if docs:
+        collection.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs], ordered=False)
+
+def update_delta_index(config, batch_size=BUILD_BATCH_SIZE):
+    """
+    Rebuild the delta index of a collection: an exact vector file and id map over every
+    document (or chunk) embedded after the newest one in the last full build's manifest.
+    Their documents are copied into the annoy collection first, so running engines can
+    hydrate the new hits as soon as they reload the delta.
+
+    The delta is rewritten from scratch on every update (it only holds what arrived since
+    the last build), so an interrupted update can simply be run again.
+    Documents embedded later than the build but with an older _id (e.g. a backfill of
+    missing embeddings) are only picked up by the next full build.
+
+    :return: Number of items in the new delta index.
+    """
+    manifest = read_manifest(config)
+    if manifest is None:
+        raise RuntimeError(f"No build manifest for '{config['document_type']}'; run preprocess.build_searchEngine first.")
+    started = time.time()
+    reducer = get_reducer(config)  # The main index's reducer (a PCA projection is loaded from its file).
+    vector_size = reducer.dimensions if reducer is not None else EMBEDDING_DIMENSIONS
+    chunk_collection_name = config.get("chunk_collection_name")
+
+    client = MongoClient(MONGO_URI)
+    db = client[config["db_name"]]
+    embedding_collection = db[config["embedding_collection_name"]]
+    annoy_collection = db[config["annoy_collection_name"]]
+    source = db[chunk_collection_name] if chunk_collection_name else embedding_collection
+    query = {"embedding": {"$exists": True}}
+    if manifest.get("max_id"):
+        query["_id"] = {"$gt": ObjectId(manifest["max_id"])}
+    projection = {"parent_id": 1, "embedding": 1} if chunk_collection_name else None
+
+    delta_vectors_path, delta_id_map_path = delta_paths(config)
+    batch = []  # Documents (or parent ids of chunks) waiting to be copied.
+    parents_copied = set()
+
+    def flush():
+        if chunk_collection_name:
+            new_parents = [parent_id for parent_id in batch if parent_id not in parents_copied]
+            parents = list(embedding_collection.find({"_id": {"$in": new_parents}}, {"embedding": 0}))
+            _upsert_copies(annoy_collection, parents)
+            parents_copied.update(new_parents)
+        else:
+            _upsert_copies(annoy_collection, batch)
+        batch.clear()
+
+    try:
+        with VectorFileWriter(delta_vectors_path + ".tmp", vector_size) as vectors, \
+                IdMapWriter(delta_id_map_path + ".tmp") as id_map:
+            cursor = source.find(query, projection, batch_size=batch_size, no_cursor_timeout=True).sort("_id", 1)
+            with cursor:
+                for doc in cursor:
+                    emb = doc.pop("embedding", None)
+                    if emb is None:
+                        continue
+                    i = id_map.count
+                    vectors.add_item(i, _reduced(emb, reducer))
+                    if chunk_collection_name:
+                        id_map.append(doc["parent_id"])
+                        batch.append(doc["parent_id"])
+                    else:
+                        id_map.append(doc["_id"])
+                        doc["map_id"] = f"delta:{i}"
+                        batch.append(doc)
+                    if len(batch) >= batch_size:
+                        flush()
+            flush()
+            count = id_map.count
+    except Exception:
+        _remove_quietly(delta_vectors_path + ".tmp")
+        _remove_quietly(delta_id_map_path + ".tmp")
+        client.close()
+        raise
+    client.close()
+
+    # A full build that finished meanwhile has dropped the delta; this one is already in its index.
+    current = read_manifest(config)
+    if current is None or current.get("max_id") != manifest.get("max_id"):
+        _remove_quietly(delta_vectors_path + ".tmp")
+        _remove_quietly(delta_id_map_path + ".tmp")
+        logger.info("A new build of '%s' finished during the delta update; discarding it.", config["document_type"])
+        return 0
+
+    # Same order as a full build: the id map first, then the file whose mtime versions the engine.
+    os.replace(delta_id_map_path + ".tmp", delta_id_map_path)
+    os.replace(delta_vectors_path + ".tmp", delta_vectors_path)
+    logger.info("Delta index of '%s' rebuilt with %d items newer than %s in %.1fs.",
+                config["document_type"], count, manifest.get("max_id"), time.time() - started)
+    return count
+
+def run_delta_updates(config, interval=DELTA_UPDATE_INTERVAL, compact_at=DELTA_COMPACT_ITEMS):
+    """
+    Keep a collection's delta index current: update it every `interval` seconds and, once
+    it holds `compact_at` items, fold it into a new main index with a full build in a
+    background thread. Searches keep using the old index and delta until the build swaps
+    its files in. Delta updates pause while it runs, since they would otherwise restore
+    the delta the build drops; the next update refills it with whatever arrived meanwhile.
+    """
+    compaction = None
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction") as pool:
+        while True:
+            if compaction is not None and compaction.done():
+                try:
+                    compaction.result()
+                    logger.info("Compaction of '%s' finished.", config["document_type"])
+                except Exception as e:
+                    logger.error("Compaction of '%s' failed: %s", config["document_type"], e)
+                compaction = None
+            if compaction is not None:
+                time.sleep(interval)
+                continue
+            try:
+                count = update_delta_index(config)
+            except Exception as e:
+                logger.error("Delta update of '%s' failed: %s", config["document_type"], e)
+                count = 0
+            if count >= compact_at:
+                logger.info("Delta index holds %d items (threshold %d); compacting into a new main index.", count, compact_at)
+                compaction = pool.submit(prebuild_annoy_index, config)
+            time.sleep(interval)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index newly embedded documents without a full rebuild.")
+    parser.add_argument("--collection", choices=list(COLLECTION), default=list(COLLECTION)[0])
+    parser.add_argument("--compact", action="store_true", help="fold the delta into a new main index now (full build)")
+    parser.add_argument("--watch", action="store_true", help="keep updating the delta and compact it when it grows too large")
+    parser.add_argument("--interval", type=int, default=DELTA_UPDATE_INTERVAL, help="seconds between delta updates with --watch")
+    parser.add_argument("--compact-at", type=int, default=DELTA_COMPACT_ITEMS, help="delta items that trigger a compaction")
+    args = parser.parse_args()
+
+    config = COLLECTION[args.collection]
+    logger.info("Using configuration: %s", config["document_type"])
+    logger.info("Selected configuration details: %s", json.dumps(config, indent=4))
+
+    if args.compact:
+        prebuild_annoy_index(config)
+    elif args.watch:
+        run_delta_updates(config, args.interval, args.compact_at)
+    else:
+        update_delta_index(config)
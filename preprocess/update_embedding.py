@@ -1,116 +1,232 @@
 import json
+import time
 import logging
-from pymongo import MongoClient
-import openai
-import tiktoken  # pip install tiktoken
+import argparse
+from pymongo import MongoClient, UpdateOne
 from config import MONGO_URI, EMBEDDING_MODEL, COLLECTION
-import datetime
+from tokenizer import truncate_batch, MAX_TOTAL_TOKENS
 from openai_service import ChatGPT
+from preprocess.job_store import JobCheckpoint, call_with_backoff, run_pipelined, format_eta
+from embedding_codec import encode_embedding
 
-# Global constant for max tokens.
-MAX_TOTAL_TOKENS = 8000
+EMBED_BATCH_TOKENS = 250000  # Token budget per embeddings request (the API allows 300k)
+EMBED_BATCH_INPUTS = 2048  # Inputs per embeddings request (API limit)
+EMBED_CONCURRENCY = 4  # Embedding requests kept in flight
+EMBED_MAX_RETRIES = 6  # Retries per request on rate limits and transient errors
+JOB_CHUNK_SIZE = 1000  # Documents per checkpoint
+TOKENIZE_BLOCK = 512  # Texts handed to the tokenizer process pool at once
 
 # Configure logging.
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
-def update_corpus_embeddings(config):
+def iter_token_batches(docs, token_budget=EMBED_BATCH_TOKENS, max_inputs=EMBED_BATCH_INPUTS):
     """
-    For each document in the corpus (as specified in config),
-    compute the embedding using OpenAI and update the document.
-    The user is prompted to choose whether to resume processing documents
-    that lack an 'embedding' field, or reprocess all documents.
+    Group documents into embedding requests that stay under a token budget.
+    Texts are truncated to MAX_TOTAL_TOKENS on the way, TOKENIZE_BLOCK at a time
+    across the tokenizer's process pool.
+
+    :return: Generator of lists of (_id, text) tuples.
     """
-    logger.info("Connecting to the database...")
+    batch, batch_tokens = [], 0
+    block = []
+
+    def tokenized(block):
+        texts = truncate_batch([text for _, text in block], MAX_TOTAL_TOKENS, EMBEDDING_MODEL)
+        return [(doc_id, text, count) for (doc_id, _), (text, count) in zip(block, texts)]
 
+    def blocks():
+        for doc in docs:
+            text = (doc.get("text") or "").strip()
+            if not text:
+                continue
+            block.append((doc["_id"], text))
+            if len(block) >= TOKENIZE_BLOCK:
+                yield tokenized(block)
+                block.clear()
+        if block:
+            yield tokenized(block)
+
+    for items in blocks():
+        for doc_id, text, token_count in items:
+            if batch and (batch_tokens + token_count > token_budget or len(batch) >= max_inputs):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append((doc_id, text))
+            batch_tokens += token_count
+    if batch:
+        yield batch
+
+def backfill_embeddings(collection, docs, service, total_count=None, processed=0,
+                        concurrency=EMBED_CONCURRENCY, token_budget=EMBED_BATCH_TOKENS):
+    """
+    Pipelined backfill: texts are batched under a token budget, up to `concurrency`
+    embedding requests are kept in flight, and the results are written back with
+    bulk_write of UpdateOne operations keyed by _id.
+
+    :param collection: Collection receiving the "embedding" field.
+    :param docs: Iterable of documents with "_id" and "text".
+    :param service: ChatGPT instance used for the embedding requests.
+    :param total_count: Documents in the collection, for progress reporting (None to disable it).
+    :param processed: Documents already embedded before this run.
+    :return: Dict with "embedded", "failed", "failures" ((_id, error) pairs) and "seconds".
+    """
+    started = time.time()
+    stats = {"embedded": 0, "failed": 0, "failures": []}
+    next_report = [processed + max(1, int((total_count or 0) / 100))]
+
+    def embed(batch):
+        return call_with_backoff(service.get_openai_embeddings, [text for _, text in batch], batch_size=len(batch),
+                                 truncate=False, max_retries=EMBED_MAX_RETRIES, description="Embedding request")
+
+    def handle(batch, embeddings, error):
+        if error is not None:
+            stats["failed"] += len(batch)
+            stats["failures"].extend((doc_id, error) for doc_id, _ in batch)
+            logger.error("Error embedding a batch of %d documents (first _id %s): %s", len(batch), batch[0][0], error)
+            return []
+        writes = []
+        for (doc_id, _), embedding in zip(batch, embeddings):
+            if embedding is None:
+                stats["failed"] += 1
+                stats["failures"].append((doc_id, "no embedding returned"))
+                continue
+            writes.append(UpdateOne({"_id": doc_id}, {"$set": {"embedding": encode_embedding(embedding)}}))
+            stats["embedded"] += 1
+        done = processed + stats["embedded"]
+        if total_count and done >= next_report[0]:
+            next_report[0] = done + max(1, int(total_count / 100))
+            rate = stats["embedded"] / max(time.time() - started, 1e-9)
+            logger.info("Progress: %.2f%% completed (%.1f docs/s)", done / total_count * 100, rate)
+        return writes
+
+    run_pipelined(iter_token_batches(docs, token_budget), embed, handle, [collection], concurrency)
+    stats["seconds"] = time.time() - started
+    return stats
+
+def _target_collection_name(config, chunks):
+    """Embed the chunk collection of a chunked configuration, or the document collection."""
+    if chunks:
+        if not config.get("chunk_collection_name"):
+            raise ValueError(f"Configuration '{config['document_type']}' has no chunk_collection_name.")
+        return config["chunk_collection_name"]
+    return config["embedding_collection_name"]
+
+def run_embedding_job(config, restart=False, reembed_all=None, chunk_size=JOB_CHUNK_SIZE,
+                      concurrency=EMBED_CONCURRENCY, chunks=False):
+    """
+    Non-interactive, resumable embedding backfill for a configuration.
+
+    Documents are read in _id order in chunks of `chunk_size` using an _id range
+    cursor, so resuming costs the same regardless of how far the job got. After each
+    chunk the last _id and counters are checkpointed in MongoDB, and documents that
+    failed go to the job's dead-letter list.
+
+    :param restart: Discard the checkpoint and start from the first document
+        (existing embeddings are overwritten, not removed up front).
+    :param reembed_all: Also re-embed documents that already have an embedding. None keeps
+        the mode of the job being resumed; a new job only embeds the missing ones.
+    :param chunk_size: Documents per checkpoint.
+    :param concurrency: Embedding requests kept in flight.
+    :param chunks: Embed the chunk collection written by preprocess.chunk_documents.
+    """
+    collection_name = _target_collection_name(config, chunks)
     with MongoClient(MONGO_URI) as client:
         db = client[config["db_name"]]
-        embedding_collection = db[config["embedding_collection_name"]]
-        logger.info("Connected to the database.")
-        total_count = embedding_collection.count_documents({})
-
-        count_missing = embedding_collection.count_documents({"embedding": {"$exists": False}})
-        logger.info(f"Total documents in collection: {total_count}")
-        logger.info(f"Documents missing embeddings: {count_missing}")
-
-        # Prompt user to choose processing mode.
-        logger.info("Choose processing mode:")
-        logger.info("  [c] Continue processing missing embeddings only")
-        logger.info("  [b] Start from beginning (process all documents)")
-        mode = input("Enter your choice (c/b): ").strip().lower()
-
-        if mode not in ['c', 'b']:
-            logger.warning("Invalid input. Defaulting to 'continue' mode.")
-            mode = 'c'
-
-        if mode == 'c':
-            docs = embedding_collection.find({"embedding": {"$exists": False}})
-            # We'll update the running count based on only the new embeddings.
-            processed = total_count - count_missing
-        else:  # mode == 'b'
-            docs = embedding_collection.find({})
-            # Optionally, you might want to remove the existing embeddings.
-            result = embedding_collection.update_many({}, {"$unset": {"embedding": ""}})
-            logger.info("Removed existing embeddings from %d documents.", result.modified_count)
-            processed = 0  # starting fresh
-
-        logger.info("Starting embedding update...")
-
-        openAI_Embeddings = ChatGPT(db,None,None,preprocess=True)
-
-        # Confirm with the user before starting.
-        user_input = input("Proceed with embedding update? (y/n): ").strip().lower()
-        if user_input != 'y':
-            logger.warning("Skipping embedding update as per user input.")
+        embedding_collection = db[collection_name]
+        job = JobCheckpoint(db, "embedding:" + collection_name)
+        if restart:
+            job.reset()
+        state = job.load()
+        last_id = state.get("last_id")
+        if reembed_all is None:
+            reembed_all = state.get("reembed_all", False)
+        service = ChatGPT(db, None, None, preprocess=True)
+
+        def range_filter(after):
+            query = {} if reembed_all else {"embedding": {"$exists": False}}
+            if after is not None:
+                query["_id"] = {"$gt": after}
+            return query
+
+        remaining = embedding_collection.count_documents(range_filter(last_id))
+        logger.info("Job '%s': resuming after _id %s (%d processed, %d failed so far); %d documents to %s.",
+                    job.job_name, last_id, state.get("processed", 0), state.get("failed", 0), remaining,
+                    "re-embed" if reembed_all else "embed")
+
+        started = time.time()
+        done = 0
+        while True:
+            chunk = list(embedding_collection.find(range_filter(last_id), {"text": 1})
+                         .sort("_id", 1).limit(chunk_size))
+            if not chunk:
+                break
+            stats = backfill_embeddings(embedding_collection, chunk, service, concurrency=concurrency)
+            last_id = chunk[-1]["_id"]
+            job.add_dead_letters(stats["failures"])
+            done += len(chunk)
+            rate = done / max(time.time() - started, 1e-9)
+            eta = (remaining - done) / rate if rate else None
+            job.advance(last_id, processed=stats["embedded"], failed=stats["failed"],
+                        docs_per_second=rate, eta_seconds=eta, reembed_all=reembed_all)
+            logger.info("Checkpoint at _id %s: %d/%d documents this run (%.2f%%), %.1f docs/s, ETA %s",
+                        last_id, done, remaining, done / remaining * 100 if remaining else 100,
+                        rate, format_eta(eta))
+
+        job.set_status("completed")
+        logger.info("Job '%s' completed: %d documents in %.1fs.", job.job_name, done, time.time() - started)
+
+def retry_dead_letters(config, concurrency=EMBED_CONCURRENCY, chunks=False):
+    """Re-embed the documents on the job's dead-letter list, removing those that succeed."""
+    collection_name = _target_collection_name(config, chunks)
+    with MongoClient(MONGO_URI) as client:
+        db = client[config["db_name"]]
+        embedding_collection = db[collection_name]
+        job = JobCheckpoint(db, "embedding:" + collection_name)
+        doc_ids = job.dead_letter_ids()
+        if not doc_ids:
+            logger.info("No dead letters for job '%s'.", job.job_name)
             return
-
-        for doc in docs:
-            text = doc.get("text", "").strip()
-            if text:
-                try:
-                    embedding = openAI_Embeddings.get_openai_embedding(text)
-                    # Convert to list if necessary.
-                    embedding_list = embedding.tolist() if hasattr(embedding, "tolist") else embedding
-
-                    # Update using the unique field specified in the config.
-                    unique_field = config.get("unique_index", "title")  # Default to "title"
-                    embedding_collection.update_one(
-                        {unique_field: doc[unique_field]},
-                        {"$set": {"embedding": embedding_list}}
-                    )
-
-                    processed += 1
-                    percentage = (processed / total_count) * 100 if total_count > 0 else 100
-                    # Log progress every ~1% progress.
-                    if processed % max(1, int(total_count / 100)) == 0:
-                        logger.info(f"Progress: {percentage:.2f}% completed")
-
-                    logger.debug("Updated embedding for document with %s: %s", unique_field, doc.get(unique_field))
-
-                except Exception as e:
-                    logger.error("Error updating embedding for document with %s: %s. Error: %s",
-                                 unique_field, doc.get(unique_field), str(e))
-
-        logger.info("Successfully completed embedding updates in the database.")
+        logger.info("Retrying %d dead-letter documents.", len(doc_ids))
+        service = ChatGPT(db, None, None, preprocess=True)
+        docs = embedding_collection.find({"_id": {"$in": doc_ids}}, {"text": 1})
+        stats = backfill_embeddings(embedding_collection, docs, service, concurrency=concurrency)
+        failed_ids = {doc_id for doc_id, _ in stats["failures"]}
+        job.clear_dead_letters([doc_id for doc_id in doc_ids if doc_id not in failed_ids])
+        job.add_dead_letters(stats["failures"])
+        logger.info("Dead-letter retry: %d embedded, %d still failing.", stats["embedded"], stats["failed"])
+
+def show_status(config, chunks=False):
+    with MongoClient(MONGO_URI) as client:
+        db = client[config["db_name"]]
+        job = JobCheckpoint(db, "embedding:" + _target_collection_name(config, chunks))
+        state = job.load()
+        state["dead_letters"] = len(job.dead_letter_ids())
+        logger.info("Job status: %s", json.dumps(state, indent=4, default=str))
 
 if __name__ == "__main__":
-    # List available configurations.
-    keys = list(COLLECTION.keys())
-    logger.info("Available configurations:")
-    for i, key in enumerate(keys, start=1):
-        doc_type = COLLECTION[key].get("document_type", "Unknown")
-        logger.info("%d: %s", i, doc_type)
-
-    try:
-        selected_num = int(input("Enter configuration number: ").strip())
-        if selected_num < 1 or selected_num > len(keys):
-            raise ValueError("Selection out of range")
-    except Exception as e:
-        logger.warning("Invalid configuration number provided. Defaulting to 1.")
-        selected_num = 1
-
-    config = COLLECTION[keys[selected_num - 1]]
+    parser = argparse.ArgumentParser(description="Resumable embedding backfill.")
+    parser.add_argument("--collection", choices=list(COLLECTION), default=list(COLLECTION)[0])
+    parser.add_argument("--restart", action="store_true", help="discard the checkpoint and start from the beginning")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--all", dest="reembed_all", action="store_const", const=True,
+                      help="re-embed every document, including those that already have an embedding")
+    mode.add_argument("--missing-only", dest="reembed_all", action="store_const", const=False,
+                      help="skip documents that already have an embedding (default for a new job)")
+    parser.add_argument("--retry-dead-letters", action="store_true", help="re-embed documents that failed earlier")
+    parser.add_argument("--status", action="store_true", help="show the checkpoint and exit")
+    parser.add_argument("--chunks", action="store_true", help="embed the chunk collection (see preprocess.chunk_documents)")
+    parser.add_argument("--chunk-size", type=int, default=JOB_CHUNK_SIZE, help="documents per checkpoint")
+    parser.add_argument("--concurrency", type=int, default=EMBED_CONCURRENCY)
+    args = parser.parse_args()
+
+    config = COLLECTION[args.collection]
     logger.info("Using configuration: %s", config["document_type"])
     logger.info("Selected configuration details: %s", json.dumps(config, indent=4))
 
-    update_corpus_embeddings(config)
+    if args.status:
+        show_status(config, args.chunks)
+    elif args.retry_dead_letters:
+        retry_dead_letters(config, args.concurrency, args.chunks)
+    else:
+        run_embedding_job(config, args.restart, args.reembed_all, args.chunk_size, args.concurrency, args.chunks)
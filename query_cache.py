@@ -0,0 +1,370 @@
+import os
+import time
+import atexit
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from pymongo import UpdateOne
+from config import (
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+    RESULT_CACHE_SIZE,
+    RESULT_CACHE_TTL,
+    RESULT_CACHE_NEAR_DUPLICATE,
+    RESULT_CACHE_WINDOW,
+    DOCUMENT_CACHE_SIZE,
+    DOCUMENT_CACHE_TTL,
+    SEARCH_COUNT_FLUSH_INTERVAL,
+)
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded in-process LRU of query embeddings with TTL expiry,
+    sitting in front of the User_queries collection.
+    """
+
+    def __init__(self, max_size=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        """
+        :param max_size: Maximum number of embeddings kept; the least recently used is evicted.
+        :param ttl: Seconds an entry stays valid after it was stored.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, embedding)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(query, model, dimensions):
+        """Cache key: the normalised query plus the model and size that produced the vector."""
+        return (query, model, dimensions)
+
+    def get(self, key):
+        """Return the cached embedding or None, counting the hit or miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, embedding = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, embedding):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dict with the current size and hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class ResultCache:
+    """
+    Bounded in-process LRU of search results keyed on
+    (collection, normalised query, k, search_k, threshold).
+
+    Entries remember the index version they were computed against and are
+    dropped once the engine reports a different version, i.e. after the index
+    is rebuilt. Optionally a query whose embedding is within a cosine bound of a
+    recently cached query's embedding reuses that query's results.
+    """
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL,
+                 near_duplicate=RESULT_CACHE_NEAR_DUPLICATE, window=RESULT_CACHE_WINDOW):
+        """
+        :param max_size: Maximum number of result lists kept.
+        :param ttl: Seconds an entry stays valid.
+        :param near_duplicate: Minimum cosine similarity for a near-duplicate hit; 0 disables the lookup.
+        :param window: Number of recent query vectors compared per (collection, k, search_k, threshold).
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.near_duplicate = near_duplicate
+        self.window = window
+        self._entries = OrderedDict()  # key -> (expires_at, version, results)
+        self._recent = {}  # key without the query -> {"vectors": ndarray, "keys": list, "next": int}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(collection, query, k, search_k, threshold):
+        return (collection, query, k, search_k, threshold)
+
+    @staticmethod
+    def _copy(results):
+        # Callers annotate and serialize the documents in place; hand out fresh dicts.
+        return [(dict(doc), similarity) for doc, similarity in results]
+
+    def _valid(self, key, version):
+        """Return the cached results for key if still fresh, evicting stale entries. Caller holds the lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, entry_version, results = entry
+        if expires_at <= time.monotonic() or entry_version != version:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return results
+
+    def get(self, key, version):
+        """Exact lookup; version is the current index version of the collection."""
+        with self._lock:
+            results = self._valid(key, version)
+            if results is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._copy(results)
+
+    def get_similar(self, key, vector, version):
+        """
+        Near-duplicate lookup: return the results of the most similar recently
+        cached query with the same collection and parameters, if it is close enough.
+        """
+        if not self.near_duplicate or vector is None:
+            return None
+        group = key[:1] + key[2:]
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        with self._lock:
+            recent = self._recent.get(group)
+            if recent is None or norm == 0 or recent["vectors"].shape[1] != vector.shape[0]:
+                return None
+            similarities = recent["vectors"] @ (vector / norm)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.near_duplicate:
+                return None
+            results = self._valid(recent["keys"][best], version)
+            if results is None:
+                return None
+            self.near_hits += 1
+            logger.info("Near-duplicate result cache hit (cosine %.4f).", similarities[best])
+            return self._copy(results)
+
+    def put(self, key, results, version, vector=None):
+        """Cache results; the query vector, if given, makes them available to near-duplicate lookups."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, version, self._copy(results))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            if not self.near_duplicate or vector is None:
+                return
+            vector = np.asarray(vector, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            if norm == 0:
+                return
+            group = key[:1] + key[2:]
+            recent = self._recent.get(group)
+            if recent is None or recent["vectors"].shape[1] != vector.shape[0]:
+                recent = {"vectors": np.zeros((self.window, vector.shape[0]), dtype=np.float32),
+                          "keys": [None] * self.window, "next": 0}
+                self._recent[group] = recent
+            # Ring buffer of the most recent query vectors for this group.
+            slot = recent["next"]
+            recent["vectors"][slot] = vector / norm
+            recent["keys"][slot] = key
+            recent["next"] = (slot + 1) % self.window
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._recent.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class DocumentCache:
+    """
+    Bounded in-process LRU of result documents (as fetched with the collection's result
+    projection) keyed on (database, collection, _id), so pages that only keep result ids
+    in the session can load their documents without a round trip each time.
+    """
+
+    def __init__(self, max_size=DOCUMENT_CACHE_SIZE, ttl=DOCUMENT_CACHE_TTL):
+        """
+        :param max_size: Maximum number of documents kept; the least recently used is evicted.
+        :param ttl: Seconds a document stays valid after it was stored.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, document)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, namespace, doc_ids):
+        """
+        :param namespace: (database name, collection name) of the documents.
+        :return: A dict {_id: document} of the cached ids (copies, so callers may modify them).
+        """
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for doc_id in doc_ids:
+                key = (namespace, doc_id)
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    found[doc_id] = dict(entry[1])
+                elif entry is not None:
+                    del self._entries[key]
+            self.hits += len(found)
+            self.misses += len(doc_ids) - len(found)
+        return found
+
+    def put_many(self, namespace, docs):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for doc in docs:
+                key = (namespace, doc["_id"])
+                self._entries[key] = (expires_at, dict(doc))
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def update(self, namespace, doc_id, fields):
+        """Apply a $set to a cached document (e.g. a newly stored summary), if it is cached."""
+        with self._lock:
+            entry = self._entries.get((namespace, doc_id))
+            if entry is not None:
+                entry[1].update(fields)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SearchCounter:
+    """
+    Searches answered from the result cache, counted in memory and added to the query
+    collection by a background flush, so a cache hit does not wait for a MongoDB write.
+    Each flush sets the query's latest result ids and increments its "searches" count,
+    like DatabaseHandler._record_results does for searches that ran.
+    """
+
+    def __init__(self, flush_interval=SEARCH_COUNT_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}  # (db, collection, query, results field) -> [collection, filter, result ids, count]
+        self._flusher = None
+
+    def add(self, collection, query_filter, results_field, result_ids):
+        """Count one search of the query matched by query_filter that returned result_ids."""
+        key = (collection.database.name, collection.name, query_filter["query"], results_field)
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [collection, query_filter, result_ids, 1]
+            else:
+                entry[2] = result_ids
+                entry[3] += 1
+        self._ensure_flusher()
+
+    def flush(self):
+        """Write the counted searches, one bulk_write per query collection."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        by_collection = {}
+        for (db_name, name, _, field), (collection, query_filter, result_ids, count) in pending.items():
+            by_collection.setdefault((db_name, name), (collection, []))[1].append(UpdateOne(
+                query_filter, {"$set": {field: result_ids}, "$inc": {"searches": count}}))
+        for (db_name, name), (collection, writes) in by_collection.items():
+            try:
+                collection.bulk_write(writes, ordered=False)
+            except Exception as e:
+                logger.error("Failed to record %d cached searches in %s.%s: %s", len(writes), db_name, name, e)
+
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name="search-count-flush", daemon=True)
+                    self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+# Shared by every DatabaseHandler in the process.
+query_embedding_cache = QueryEmbeddingCache()
+result_cache = ResultCache()
+document_cache = DocumentCache()
+search_counter = SearchCounter()
+
+
+def _reset_after_fork():
+    # Searches counted by the parent are flushed by the parent.
+    global search_counter
+    search_counter = SearchCounter()
+
+
+atexit.register(lambda: search_counter.flush())
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+_indexed_collections = set()
+
+def ensure_query_indexes(collection):
+    """
+    Create the lookup index on a query collection once per process,
+    so cached-embedding lookups no longer scan the collection.
+    """
+    key = (collection.database.name, collection.name)
+    if key in _indexed_collections:
+        return
+    try:
+        collection.create_index([("query", 1), ("model", 1), ("dimensions", 1)], name="query_model_dimensions")
+        _indexed_collections.add(key)
+    except Exception as e:
+        logger.error("Could not create index on '%s': %s", collection.name, e)
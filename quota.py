@@ -0,0 +1,208 @@
+import os
+import time
+import atexit
+import logging
+import datetime
+import threading
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from config import LIMIT, QUOTA_BLOCK_SIZE, QUOTA_FLUSH_INTERVAL
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+SEARCH_LIMITS_COLLECTION = "search_limits"
+
+
+class DailyQuota:
+    """
+    Process-local token bucket over the daily OpenAI request limit.
+
+    Each day has one document in search_limits: "reserved" counts the requests handed out
+    to processes and enforces LIMIT, "OpenAPI_Request" counts the requests actually made
+    (as before). A process reserves QUOTA_BLOCK_SIZE requests at a time with one atomic
+    findOneAndUpdate and serves them from memory; usage is added to "OpenAPI_Request" by a
+    background flush, and unused tokens are given back at exit. Because a block is granted
+    only as far as it fits under LIMIT, the workers together never exceed it; at most
+    QUOTA_BLOCK_SIZE tokens per worker sit unused until that worker exits.
+    """
+
+    def __init__(self, db, limit=LIMIT, block_size=QUOTA_BLOCK_SIZE, flush_interval=QUOTA_FLUSH_INTERVAL):
+        """
+        :param db: MongoDB database holding the search_limits collection.
+        :param limit: Requests allowed per day across every process.
+        :param block_size: Requests reserved from MongoDB at a time.
+        :param flush_interval: Seconds between background flushes of the usage count.
+        """
+        self.collection = db[SEARCH_LIMITS_COLLECTION]
+        self.limit = limit
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._day = None
+        self._tokens = 0  # Reserved for self._day and not yet used.
+        self._exhausted = False  # The day's limit has been reached by the reservations.
+        self._pending = {}  # day -> requests made but not yet flushed
+        self._flushed_usage = None  # "OpenAPI_Request" of today as of the last flush (None: not read yet)
+        self._indexed = False
+        self._flusher = None
+
+    @staticmethod
+    def today():
+        return datetime.date.today().isoformat()
+
+    def _roll_day(self):
+        """Start a new day: tokens reserved for the previous one are worthless now."""
+        today = self.today()
+        if today != self._day:
+            self._day = today
+            self._tokens = 0
+            self._exhausted = False
+            self._flushed_usage = None
+        return today
+
+    def _reserve(self, day):
+        """Reserve up to block_size requests of the day's limit; returns the number granted."""
+        if not self._indexed:
+            self.collection.create_index("date", unique=True)
+            self._indexed = True
+        # Days recorded before reservations existed start reserving from their usage.
+        update = [{"$set": {"reserved": {"$add": [
+            {"$ifNull": ["$reserved", {"$ifNull": ["$OpenAPI_Request", 0]}]}, self.block_size]}}}]
+        try:
+            record = self.collection.find_one_and_update(
+                {"date": day}, update, upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Another process created the day's document at the same moment.
+            record = self.collection.find_one_and_update(
+                {"date": day}, update, upsert=True, return_document=ReturnDocument.AFTER)
+        start = record["reserved"] - self.block_size
+        granted = max(0, min(self.block_size, self.limit - start))
+        if granted < self.block_size:
+            # Hand back the part above the limit so the counter stays meaningful.
+            self.collection.update_one({"date": day}, {"$inc": {"reserved": granted - self.block_size}})
+            self._exhausted = True
+        logger.info("Reserved %d requests of today's quota (%d/%d reserved).", granted, start + granted, self.limit)
+        return granted
+
+    def try_acquire(self, count=1):
+        """
+        Take `count` requests from the bucket, reserving a new block when it runs dry.
+
+        :return: True if the requests may be made, False once today's limit is reached.
+        """
+        with self._lock:
+            day = self._roll_day()
+            while self._tokens < count:
+                if self._exhausted:
+                    return False
+                self._tokens += self._reserve(day)
+            self._tokens -= count
+            self._pending[day] = self._pending.get(day, 0) + count
+        self._ensure_flusher()
+        return True
+
+    def refund(self, count=1):
+        """Return requests taken by try_acquire that were not made after all."""
+        with self._lock:
+            day = self._roll_day()
+            if self._pending.get(day, 0) >= count:
+                self._pending[day] -= count
+                self._tokens += count
+
+    def has_capacity(self):
+        """True if a request could be made now (reserves a block if the bucket is empty)."""
+        with self._lock:
+            day = self._roll_day()
+            if not self._tokens and not self._exhausted:
+                self._tokens += self._reserve(day)
+            return self._tokens > 0
+
+    def usage(self):
+        """Requests made today: the flushed count plus this process' unflushed ones."""
+        with self._lock:
+            day = self._roll_day()
+            if self._flushed_usage is None:
+                record = self.collection.find_one({"date": day}, {"OpenAPI_Request": 1})
+                self._flushed_usage = record.get("OpenAPI_Request", 0) if record else 0
+            return self._flushed_usage + self._pending.get(day, 0)
+
+    def flush(self):
+        """Add the requests made since the last flush to "OpenAPI_Request"."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for day, count in pending.items():
+            if not count:
+                continue
+            try:
+                record = self.collection.find_one_and_update(
+                    {"date": day}, {"$inc": {"OpenAPI_Request": count}},
+                    upsert=True, return_document=ReturnDocument.AFTER)
+            except Exception as e:
+                logger.error("Failed to flush %d requests of %s: %s", count, day, e)
+                with self._lock:
+                    self._pending[day] = self._pending.get(day, 0) + count
+                continue
+            with self._lock:
+                if day == self._day:
+                    self._flushed_usage = record["OpenAPI_Request"]
+            logger.info("Usage of %s updated to %d.", day, record["OpenAPI_Request"])
+
+    def release(self):
+        """Flush usage and give this process' unused tokens back (e.g. at exit)."""
+        self.flush()
+        with self._lock:
+            day, tokens, self._tokens = self._day, self._tokens, 0
+        if day is not None and tokens:
+            self.collection.update_one({"date": day}, {"$inc": {"reserved": -tokens}})
+            logger.info("Released %d unused requests of %s.", tokens, day)
+
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name="quota-flush", daemon=True)
+                    self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+# Process-wide quotas, one per database.
+_quotas = {}
+_quotas_lock = threading.Lock()
+
+
+def get_quota(db):
+    """Return the process-wide DailyQuota of a database, creating it on first use."""
+    quota = _quotas.get(db.name)
+    if quota is None:
+        with _quotas_lock:
+            quota = _quotas.get(db.name)
+            if quota is None:
+                quota = _quotas[db.name] = DailyQuota(db)
+    return quota
+
+
+def release_all():
+    """Flush and release every quota of this process."""
+    for quota in list(_quotas.values()):
+        try:
+            quota.release()
+        except Exception as e:
+            logger.error("Failed to release quota: %s", e)
+
+
+def _reset_after_fork():
+    # The parent keeps its tokens and unflushed usage; a forked worker reserves its own.
+    global _quotas, _quotas_lock
+    _quotas = {}
+    _quotas_lock = threading.Lock()
+
+
+atexit.register(release_all)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,207 @@
+import os
+import zlib
+import logging
+import numpy as np
+from annoy import AnnoyIndex
+from config import IVF_NPROBE, IVF_RERANK
+from dimension_reduction import _normalise
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# A search backend answers nearest-neighbour queries for AnnoySearch through the
+# subset of the AnnoyIndex API it uses:
+#
+#     get_nns_by_vector(vector, n, search_k=-1, include_distances=True) -> (items, distances)
+#     get_n_items()
+#     unload()
+#
+# Items are row numbers of the id map, and distances are Annoy angular distances
+# (sqrt(2 - 2 * cosine)), so thresholds and scores mean the same for every backend.
+BACKENDS = ("annoy", "exact", "ivfpq")
+
+
+def _angular_distances(similarities):
+    return np.sqrt(np.maximum(2.0 - 2.0 * similarities, 0.0))
+
+
+class ExactBackend:
+    """
+    Exact cosine search over a headerless file of unit-length float32 rows (row i is item i),
+    memory-mapped read-only. One matrix-vector product plus argpartition per query, which for
+    small collections is both exact and faster than walking Annoy trees.
+    """
+
+    def __init__(self, path, vector_size):
+        self.path = path
+        self.vector_size = vector_size
+        if os.path.getsize(path) == 0:
+            self.vectors = np.empty((0, vector_size), dtype=np.float32)
+        else:
+            self.vectors = np.memmap(path, dtype="<f4", mode="r").reshape(-1, vector_size)
+
+    def get_n_items(self):
+        return len(self.vectors)
+
+    def similarities(self, vector):
+        """Cosine similarity of the query with every row."""
+        query = _normalise(np.asarray(vector, dtype=np.float32))
+        return self.vectors @ query
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=True):
+        """Exact top-n; search_k is accepted for API compatibility and ignored."""
+        n = min(n, len(self.vectors))
+        if n <= 0:
+            return ([], []) if include_distances else []
+        sims = self.similarities(vector)
+        top = np.argpartition(-sims, n - 1)[:n]
+        top = top[np.argsort(-sims[top])]
+        if not include_distances:
+            return top.tolist()
+        return top.tolist(), _angular_distances(sims[top]).tolist()
+
+    def unload(self):
+        self.vectors = np.empty((0, self.vector_size), dtype=np.float32)
+
+
+class VectorFileWriter:
+    """Appends unit-length float32 rows to the file read by ExactBackend; the n-th row is item n."""
+
+    def __init__(self, path, vector_size):
+        self.path = path
+        self.vector_size = vector_size
+        self.count = 0
+        self._file = open(path, "wb")
+
+    def add_item(self, i, vector):
+        if i != self.count:
+            raise ValueError(f"Vectors must be added in item order (expected {self.count}, got {i}).")
+        row = _normalise(np.asarray(vector, dtype="<f4"))
+        if row.shape != (self.vector_size,):
+            raise ValueError(f"Expected a {self.vector_size}-dimensional vector, got shape {row.shape}.")
+        self._file.write(row.astype("<f4").tobytes())
+        self.count += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def index_path(config):
+    """The file a collection's backend loads, whose mtime versions the loaded engine."""
+    backend = config.get("backend", "annoy")
+    if backend == "exact":
+        return vectors_path(config)
+    if backend == "ivfpq":
+        return ivfpq_path(config)
+    return config["annoy_index_path"]
+
+
+def shard_of(value, shards):
+    """Shard of a document from its shard key value (stable across processes and runs)."""
+    return zlib.crc32(str(value).encode("utf-8")) % shards
+
+
+def _shard_path(path, shard):
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard{shard}{ext}"
+
+
+def shard_paths(config):
+    """
+    (index path, id map path) of every shard of a collection, in shard order.
+    Unsharded collections ("shards" unset or 1) have a single pair: their usual files.
+    """
+    shards = config.get("shards", 1)
+    paths = (index_path(config), config["id_map_path"])
+    if shards <= 1:
+        return [paths]
+    if config.get("backend", "annoy") == "ivfpq":
+        raise ValueError("The ivfpq backend is already partitioned into lists; it cannot be sharded.")
+    return [(_shard_path(paths[0], shard), _shard_path(paths[1], shard)) for shard in range(shards)]
+
+
+def files_version(paths):
+    """
+    Version of a set of index files: the mtime of a single file, or the tuple of
+    mtimes for shards, so rebuilding any one shard changes it. None if a file is missing.
+    """
+    try:
+        versions = tuple(os.stat(path).st_mtime_ns for path in paths)
+    except OSError:
+        return None
+    return versions[0] if len(versions) == 1 else versions
+
+
+def index_version(paths, delta_path=None):
+    """
+    Version of a loaded engine: files_version of its index files, paired with the mtime
+    of its delta vector file (None while there is no delta) when it has a delta index.
+    """
+    version = files_version(paths)
+    if version is None or delta_path is None:
+        return version
+    try:
+        delta_version = os.stat(delta_path).st_mtime_ns
+    except OSError:
+        delta_version = None
+    return version, delta_version
+
+
+def delta_paths(config):
+    """
+    (vector file, id map) of a collection's delta index: the documents embedded since its
+    last full build, searched exactly alongside the main index until the next build.
+    """
+    base = os.path.splitext(config["annoy_index_path"])[0]
+    return base + "_delta_vectors.bin", base + "_delta_id_map.bin"
+
+
+def manifest_path(config):
+    """Where the manifest of a collection's last full build is written."""
+    return os.path.splitext(config["annoy_index_path"])[0] + "_manifest.json"
+
+
+def vectors_path(config):
+    """Where a collection's float32 vector file lives: next to its Annoy index unless "vectors_path" is set."""
+    return config.get("vectors_path") or os.path.splitext(config["annoy_index_path"])[0] + "_vectors.bin"
+
+
+def ivfpq_path(config):
+    """Where a collection's IVF-PQ model lives (its codes file sits next to it)."""
+    return config.get("ivfpq_path") or os.path.splitext(config["annoy_index_path"])[0] + "_ivfpq.npz"
+
+
+def backend_options(config):
+    """Backend-specific keyword arguments for load_backend."""
+    if config.get("backend", "annoy") == "ivfpq":
+        return {"vectors_path": vectors_path(config),
+                "nprobe": config.get("nprobe", IVF_NPROBE),
+                "rerank": config.get("rerank", IVF_RERANK)}
+    return {}
+
+
+def load_backend(kind, path, vector_size, **options):
+    """
+    Open the index file of a backend read-only.
+
+    :param options: Backend-specific settings (see backend_options).
+    """
+    if kind == "annoy":
+        index = AnnoyIndex(vector_size, 'angular')
+        # Annoy mmaps the file, so the pages are shared by every process that loads it.
+        index.load(path, prefault=False)
+        return index
+    if kind == "exact":
+        return ExactBackend(path, vector_size)
+    if kind == "ivfpq":
+        from ivfpq import IVFPQBackend  # ivfpq builds on this module
+        return IVFPQBackend(path, vector_size, **options)
+    raise ValueError("Unknown search backend %r; expected one of %s." % (kind, ", ".join(BACKENDS)))
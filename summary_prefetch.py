@@ -0,0 +1,84 @@
+import logging
+import gevent
+from config import SUMMARY_PREFETCH_AHEAD, SUMMARY_PREFETCH_WAIT
+from quota import get_quota
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# Summaries being generated in the background in this process: (collection, document id) -> greenlet.
+_in_flight = {}
+
+
+def _key(chat_service, case):
+    return chat_service.collection_name, str(case["_id"])
+
+
+def _summarize(chat_service, case, key):
+    try:
+        return chat_service.summarize_cases(case)
+    finally:
+        _in_flight.pop(key, None)
+
+
+def prefetch_summaries(chat_service, cases, budget, ahead=SUMMARY_PREFETCH_AHEAD):
+    """
+    Start generating the summaries of the next results in background greenlets,
+    so the user does not wait for them when paging on.
+
+    :param chat_service: ChatGPT bound to the result collection.
+    :param cases: Upcoming results (case dictionaries, best first); the first `ahead` are prefetched.
+    :param budget: Summaries this session may still prefetch.
+    :return: String ids of the documents whose summary generation was started.
+    """
+    started = []
+    quota = get_quota(chat_service.db)
+    for case in cases[:ahead]:
+        if len(started) >= budget:
+            break
+        key = _key(chat_service, case)
+        if case.get("summary") or key in _in_flight:
+            continue
+        if not quota.has_capacity():
+            logger.info("Daily limit reached; not prefetching summaries.")
+            break
+        # The greenlet works on a copy: the caller's case may live in the session.
+        _in_flight[key] = gevent.spawn(_summarize, chat_service, dict(case), key)
+        started.append(key[1])
+    if started:
+        logger.info("Prefetching %d summaries in the background.", len(started))
+    return started
+
+
+def get_summary(chat_service, case, timeout=SUMMARY_PREFETCH_WAIT):
+    """
+    Summary of a case for display: waits for a prefetch already generating it
+    instead of requesting the same summary twice, otherwise see ChatGPT.summarize_cases.
+    """
+    greenlet = _in_flight.get(_key(chat_service, case))
+    if greenlet is not None:
+        try:
+            summary = greenlet.get(timeout=timeout)
+        except gevent.Timeout:
+            logger.warning("Prefetched summary of %s not ready after %ss; requesting it directly.", case["_id"], timeout)
+        except Exception as e:
+            logger.error("Prefetching the summary of %s failed: %s", case["_id"], e)
+        else:
+            if summary:
+                case["summary"] = summary
+                return summary
+    return chat_service.summarize_cases(case)
+
+
+def stream_summary(chat_service, case, timeout=SUMMARY_PREFETCH_WAIT):
+    """
+    Pieces of a case's summary for streaming (see ChatGPT.stream_summary). A summary
+    being prefetched is awaited and sent whole rather than requested a second time.
+    """
+    if _in_flight.get(_key(chat_service, case)) is not None and not case.get("summary"):
+        summary = get_summary(chat_service, case, timeout)
+        if summary:
+            yield summary
+        return
+    yield from chat_service.stream_summary(case)
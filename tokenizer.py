@@ -0,0 +1,104 @@
+import atexit
+import logging
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import tiktoken  # pip install tiktoken
+from config import EMBEDDING_MODEL
+
+# Configure logging.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# Global constant for max tokens.
+MAX_TOTAL_TOKENS = 8000
+# Characters encoded per allowed token on the first attempt at encoding only a prefix.
+PREFIX_CHARS_PER_TOKEN = 8
+# Extra tokens required beyond the limit before trusting a prefix encoding: only the last
+# word of the prefix can tokenize differently from the full text.
+BOUNDARY_MARGIN = 32
+# Batches smaller than this are tokenized in-process; a process pool is not worth it.
+POOL_MIN_BATCH = 64
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=EMBEDDING_MODEL):
+    """Return the tiktoken encoding for a model, loaded once per process."""
+    return tiktoken.encoding_for_model(model)
+
+
+def _encode(encoding, text):
+    # Special-token text in documents is embedded as plain text rather than rejected.
+    return encoding.encode(text, disallowed_special=())
+
+
+def encode_limited(text, max_tokens=MAX_TOTAL_TOKENS, model=EMBEDDING_MODEL):
+    """
+    Return (tokens, truncated): the first max_tokens tokens of text, encoding only
+    as much of the text as needed rather than the whole (possibly megabyte) string.
+    """
+    encoding = get_encoding(model)
+    prefix_chars = max_tokens * PREFIX_CHARS_PER_TOKEN
+    while prefix_chars < len(text):
+        # Cut at whitespace so the prefix tokenizes like the start of the full text.
+        cut = text.rfind(" ", 0, prefix_chars)
+        tokens = _encode(encoding, text[:cut if cut > 0 else prefix_chars])
+        if len(tokens) > max_tokens + BOUNDARY_MARGIN:
+            return tokens[:max_tokens], True
+        prefix_chars *= 2
+    tokens = _encode(encoding, text)
+    return tokens[:max_tokens], len(tokens) > max_tokens
+
+
+def count_tokens(text, model=EMBEDDING_MODEL):
+    return len(_encode(get_encoding(model), text))
+
+
+def truncate_text(text, max_tokens=MAX_TOTAL_TOKENS, model=EMBEDDING_MODEL):
+    """
+    Return text cut to at most max_tokens tokens.
+    Texts whose UTF-8 size is within the limit are returned without encoding
+    (every token covers at least one byte).
+    """
+    if len(text) <= max_tokens and len(text.encode("utf-8")) <= max_tokens:
+        return text
+    tokens, truncated = encode_limited(text, max_tokens, model)
+    if not truncated:
+        return text
+    logger.info("Text is too long. Truncating to %d tokens.", max_tokens)
+    return get_encoding(model).decode(tokens)
+
+
+def truncate_with_count(text, max_tokens=MAX_TOTAL_TOKENS, model=EMBEDDING_MODEL):
+    """Return (text cut to max_tokens, its token count)."""
+    tokens, truncated = encode_limited(text, max_tokens, model)
+    if truncated:
+        text = get_encoding(model).decode(tokens)
+    return text, len(tokens)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned rather than forked: callers already run embedding threads.
+            _pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(_pool.shutdown)
+    return _pool
+
+
+def truncate_batch(texts, max_tokens=MAX_TOTAL_TOKENS, model=EMBEDDING_MODEL, use_pool=True):
+    """
+    Batch form of truncate_with_count. Large batches are spread over a shared
+    process pool, so tokenizing a backfill does not run on a single core.
+
+    :return: A list of (text, token_count) in the order of texts.
+    """
+    worker = functools.partial(truncate_with_count, max_tokens=max_tokens, model=model)
+    if not use_pool or len(texts) < POOL_MIN_BATCH:
+        return [worker(text) for text in texts]
+    return list(_get_pool().map(worker, texts, chunksize=max(1, len(texts) // 32)))